@@ -1,8 +1,13 @@
 from typing import List, Dict
 
 class ZTPKeyDataAccumulator:
-    def __init__(self, nodes: List[str]):
+    def __init__(self, nodes: List[str], keystore=None, erasure=None, shamir=None):
         self.nodes = nodes  # List of node identifiers
+        self.keystore = keystore  # Optional keystore.KeyStore, looked up by record id
+        self.erasure = erasure  # Optional erasure.ReedSolomon the chunks were encoded with
+        self.chunk_shards = {}  # chunk id -> {shard index: shard} received so far
+        self.chunk_lengths = {}  # chunk id -> length of the erasure coded chunk
+        self.shamir = shamir  # Optional shamir.Shamir: the fragments are t-of-n shares of the key
         self.fragmented_keys = {}  # Dictionary to store fragmented keys by identifier
         self.data_chunks = {}  # Dictionary to store data chunks by identifier
         self.key_validity = {}  # Dictionary to track key validity after consensus
@@ -13,6 +18,9 @@ class ZTPKeyDataAccumulator:
         Simulate binary search to find nodes storing a specific fragment or chunk.
         For simplicity, this just returns a subset of nodes for the fragment.
         """
+        # Keystore record ids are integers, not part of the node names: any node may serve them
+        if not isinstance(identifier, str):
+            return list(nodes)
         # Here we assume the node search is based on identifier in this mock-up.
         return [node for node in nodes if identifier in node]
 
@@ -20,13 +28,38 @@ class ZTPKeyDataAccumulator:
         """
         Simulate requesting a fragment of the key from nodes. In real-world, this would involve network calls.
         """
+        # Fragments held in the keystore are read from the mapped file, without loading the store
+        if self.keystore is not None and fragment_id in self.keystore:
+            return self.keystore.get(fragment_id)
         # Assume that we can fetch the fragmented key from some dictionary
         return self.fragmented_keys.get(fragment_id, "")
 
+    def collect_shards(self, shard_map: Dict, holders: Dict, block_id=None) -> List[int]:
+        """
+        Fetch the erasure shards of every chunk of a block from the nodes holding them.
+        shard_map is the {chunk index: (length, node id of every shard)} recorded on the
+        leaders by the distribution (metadata["shards"]), holders maps the node ids to the
+        reachable nodes (their shards are keyed by (block id, chunk index, shard index)).
+        Return the chunk ids to accumulate, the chunk indices in order.
+        """
+        for index, (length, node_ids) in shard_map.items():
+            shards = {}
+            for shard_index, node_id in enumerate(node_ids):
+                node = holders.get(node_id)
+                shard = None if node is None else node.shards.get((block_id, index, shard_index))
+                if shard is not None:
+                    shards[shard_index] = shard
+            self.chunk_shards[index] = shards
+            self.chunk_lengths[index] = length
+        return sorted(shard_map)
+
     def request_chunk(self, nodes: List[str], chunk_id: str) -> str:
         """
         Simulate requesting a data chunk from nodes. In real-world, this would involve network calls.
         """
+        # Erasure coded chunks are rebuilt from any k of their shards
+        if self.erasure is not None and chunk_id in self.chunk_shards:
+            return self.erasure.decode(self.chunk_shards[chunk_id], self.chunk_lengths[chunk_id])
         # Assume that we can fetch the data chunk from some dictionary
         return self.data_chunks.get(chunk_id, "")
 
@@ -34,12 +67,16 @@ class ZTPKeyDataAccumulator:
         """
         Incrementally assemble the key from fragments.
         """
+        if not key:
+            return fragment  # the key takes the type (str or bytes) of its fragments
         return key + fragment  # Simply concatenating fragments in this example
 
     def incremental_assemble_data(self, data: str, chunk: str) -> str:
         """
         Incrementally assemble data chunks.
         """
+        if not data:
+            return chunk  # the data takes the type (str or bytes) of its chunks, bytes when rebuilt from shards
         return data + chunk  # Simply concatenating chunks in this example
 
     def validate_key_consensus(self, key: str, nodes: List[str]) -> bool:
@@ -87,15 +124,27 @@ class ZTPKeyDataAccumulator:
         # Initialize empty key and data
         k = ""
         d = ""
+        shares = []  # Shamir shares received so far
 
         # Assemble and validate key fragments
         for i in range(len(f_i)):
+            # With Shamir sharing, the first t shares give the key, the others are not requested
+            if self.shamir is not None and len(shares) == self.shamir.t:
+                break
             # Find nodes storing fragment
             N_i = self.binary_search_nodes(f_i[i], N)
             # Request the fragment
             k_f[i] = self.request_fragment(N_i, f_i[i])
             # Incrementally assemble the key
-            k = self.incremental_assemble_key(k, k_f[i])
+            if self.shamir is not None:
+                if not k_f[i]:
+                    continue  # share lost, try the next one
+                shares.append(k_f[i])
+                if len(shares) < self.shamir.t:
+                    continue
+                k = self.shamir.combine_key(shares)
+            else:
+                k = self.incremental_assemble_key(k, k_f[i])
             # Validate key assembly
             if self.validate_key_consensus(k, N_i):
                 if self.is_valid_consensus(True):  # In real-world this would be consensus-based
@@ -147,3 +196,45 @@ class ZTPKeyDataAccumulator:
 # # Print final results
 # print(f"Final Key: {key}")
 # print(f"Final Data: {data}")
+
+
+def erasure_demo(size=100000, chunk_size=4096, k=4, n=6, lost=2):
+    """
+    Distribution side and accumulator of erasure coded chunks: every chunk of an encrypted
+    block is encoded into n shards held by n distinct nodes (as key-dist store_chunk does),
+    lost nodes disappear, then the accumulator rebuilds the block from the shards left.
+    """
+    import contextlib, io, os
+    from erasure import ReedSolomon
+
+    class Node:
+        def __init__(self, node_id):
+            self.node_id = node_id
+            self.shards = {}
+
+    erasure = ReedSolomon(k, n)
+    nodes = [Node(i) for i in range(2 * n)]
+    block_id = 7
+    block = os.urandom(size)
+    shard_map = {}
+    for index, start in enumerate(range(0, size, chunk_size)):
+        chunk = block[start:start + chunk_size]
+        holders = [nodes[(index + i) % len(nodes)] for i in range(n)]
+        for shard_index, (shard, node) in enumerate(zip(erasure.encode(chunk), holders)):
+            node.shards[(block_id, index, shard_index)] = shard.tobytes()
+        shard_map[index] = (len(chunk), [node.node_id for node in holders])
+    # the first lost nodes are unreachable: every chunk they held a shard of misses it
+    reachable = {node.node_id: node for node in nodes[lost:]}
+
+    accumulator = ZTPKeyDataAccumulator([f"node_{node.node_id}" for node in nodes], erasure=erasure)
+    chunk_ids = accumulator.collect_shards(shard_map, reachable, block_id)
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, data = accumulator.ZTP_Key_Data_Accumulate(accumulator.nodes, [], [], list(chunk_ids), "seeker_1")
+    missing = sum(n - len(shards) for shards in accumulator.chunk_shards.values())
+    assert data == block
+    print(f"RS({k},{n}): {len(chunk_ids)} chunks of {chunk_size} bytes, {lost} of {len(nodes)} nodes lost, "
+          f"{missing} shards missing, {len(data)} bytes rebuilt identical to the block")
+
+
+if __name__ == '__main__':
+    erasure_demo()
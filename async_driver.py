@@ -0,0 +1,263 @@
+#Event driven master loop of the blockchain cluster work queues
+__all__=['AsyncMasterDriver']
+
+import asyncio
+import threading
+import time
+from mpi4py import MPI
+from multi_work_queue import MultiWorkQueue
+
+
+class AsyncMasterDriver:
+    """
+    Drive a WorkQueue or a MultiWorkQueue from an asyncio loop. do_work and
+    get_completed_work are only called when a slave sent a message (it is
+    ready or completed its work), new work was added or a delayed retry
+    became eligible, instead of spinning on them.
+
+    By default the loop polls with Iprobe and an exponential backoff between
+    min_delay and max_delay seconds. With threaded (and MPI_THREAD_MULTIPLE)
+    a daemon progress thread does the same polling and wakes the loop, so
+    the loop itself only wakes up for work. Neither blocks in Probe: MPICH
+    busy-waits inside it, burning a core for the whole idle time. A message
+    still pending after the wakeup it caused (nothing consumed it) only
+    wakes the loop again once the backoff reached max_delay.
+    """
+
+    def __init__(self, queue, comm=None, min_delay=0.0005, max_delay=0.01, threaded=False):
+        self.queue     = queue
+        self.comm      = comm if comm is not None else MPI.COMM_WORLD
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.threaded  = threaded and MPI.Query_thread() == MPI.THREAD_MULTIPLE
+        self.loop      = None
+        self.wakeup    = None   # asyncio.Event set by messages and new work
+        self.armed     = threading.Event()
+        self.thread    = None
+        self.last_hit  = None   # (source, tag) of the message of the last wakeup, while it is pending
+        self.wakeups   = 0
+        self.idle_time = 0.0
+        self.cpu_time  = 0.0
+        self.wall_time = 0.0
+
+    def add_work(self, *args, **kwargs):
+        """
+        Same arguments of the add_work of the driven queue. It can be called
+        from another thread while the driver is running
+        """
+        self.queue.add_work(*args, **kwargs)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def run(self, on_result=None, until_done=True):
+        """
+        Dispatch the queued work and pass every completed result to
+        on_result(task_id, result) (task_id is None for a WorkQueue). Return
+        when the queue is done, or never if until_done is False
+        """
+        self.loop   = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        if self.threaded and self.thread is None:
+            self.thread = threading.Thread(target=self.__progress_thread, daemon=True)
+            self.thread.start()
+
+        cpu_start  = time.process_time()
+        wall_start = time.monotonic()
+        try:
+            while True:
+                self.__progress(on_result)
+                if until_done and self.queue.done():
+                    break
+                idle_start = time.monotonic()
+                await self.__wait()
+                self.idle_time += time.monotonic() - idle_start
+                self.wakeups   += 1
+        finally:
+            self.cpu_time  += time.process_time() - cpu_start
+            self.wall_time += time.monotonic() - wall_start
+            self.loop = None
+
+    def stats(self):
+        """
+        Return the wakeups and the CPU/wall time spent by the driver, compare
+        cpu_time with the wall_time of the polling loop to see the saved CPU
+        """
+        return {'threaded': self.threaded,
+                'wakeups': self.wakeups,
+                'cpu_time': self.cpu_time,
+                'wall_time': self.wall_time,
+                'idle_time': self.idle_time}
+
+    def __work_queues(self):
+        if isinstance(self.queue, MultiWorkQueue):
+            return list(self.queue.work_queue.items())
+        return [(None, self.queue)]
+
+    def __progress(self, on_result):
+        """
+        Collect the completed work first, so that the slaves it frees get new
+        work in the same wakeup
+        """
+        for task_id, work_queue in self.__work_queues():
+            for result in work_queue.get_completed_work():
+                if on_result is not None:
+                    on_result(task_id, result)
+        self.queue.do_work()
+
+    def __next_retry(self):
+        """
+        Return the seconds until the next delayed retry becomes eligible
+        """
+        eligible = [wq.retry_queue[0][0] for _, wq in self.__work_queues() if wq.retry_queue]
+        if not eligible:
+            return None
+        return max(0.0, min(eligible) - time.monotonic())
+
+    async def __wait(self):
+        """
+        Sleep until a slave message arrives, new work is added or the next
+        retry is due
+        """
+        timeout = self.__next_retry()
+        if self.threaded:
+            # let the progress thread probe for the next message
+            self.armed.set()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            delay    = self.min_delay
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.wakeup.is_set() and not self.__probe(delay):
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, self.max_delay)
+        self.wakeup.clear()
+
+    def __probe(self, delay):
+        """
+        True when a slave message is pending. The message of the last wakeup
+        (same source and tag) still pending was not consumed by the work
+        queues: it only counts again once delay backed off to max_delay
+        """
+        status = MPI.Status()
+        if not self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status):
+            self.last_hit = None
+            return False
+        hit = (status.Get_source(), status.Get_tag())
+        if hit == self.last_hit and delay < self.max_delay:
+            return False
+        self.last_hit = hit
+        return True
+
+    def __progress_thread(self):
+        """
+        Poll Iprobe with the same backoff of the loop until a slave message
+        is pending, then wake the loop and wait to be re-armed once the loop
+        consumed the message
+        """
+        while True:
+            self.armed.wait()
+            self.armed.clear()
+            delay = self.min_delay
+            while not self.__probe(delay):
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+            loop = self.loop
+            if loop is not None:
+                try:
+                    loop.call_soon_threadsafe(self.wakeup.set)
+                except RuntimeError:
+                    # the loop was closed meanwhile
+                    pass
+
+
+def spin_loop(queue, on_result=None):
+    """
+    The master loop the driver replaces: done, get_completed_work and
+    do_work called back to back, whether a slave sent something or not.
+    Return its CPU and wall time and the number of rounds
+    """
+    cpu_start, wall_start, rounds = time.process_time(), time.monotonic(), 0
+    while not queue.done():
+        for result in queue.get_completed_work():
+            if on_result is not None:
+                on_result(None, result)
+        queue.do_work()
+        rounds += 1
+    return {'cpu_time': time.process_time() - cpu_start,
+            'wall_time': time.monotonic() - wall_start,
+            'wakeups': rounds}
+
+
+def benchmark(messages=50, interval=0.1,
+              modes=(('spin loop', None), ('polling', False), ('threaded', True)), unconsumed=(False, True)):
+    """
+    mpiexec -n 2: rank 1 sends messages messages interval seconds apart,
+    the driver on rank 0 receives them. Report the CPU time of rank 0 per
+    wall second and the latency from send to receive, for every mode, the
+    baseline spin loop included (threaded None). With unconsumed, rank 1
+    first sends a message on a tag the queue never receives, left pending
+    for the whole run
+    """
+    comm = MPI.COMM_WORLD
+    if comm.Get_size() < 2:
+        raise SystemExit("run with mpiexec -n 2")
+
+    class _Queue:
+        def __init__(self):
+            self.retry_queue = []
+            self.latency     = []
+            self.stopped     = False
+        def add_work(self, *args, **kwargs):
+            pass
+        def get_completed_work(self):
+            return []
+        def do_work(self):
+            while comm.Iprobe(source=1, tag=0):
+                sent = comm.recv(source=1, tag=0)
+                if sent is None:
+                    self.stopped = True
+                else:
+                    self.latency.append(time.time() - sent)
+        def done(self):
+            return self.stopped
+
+    for stray in unconsumed:
+        for name, threaded in modes:
+            comm.Barrier()
+            if comm.Get_rank() == 1:
+                if stray:
+                    comm.send('stray', dest=0, tag=1)
+                for _ in range(messages):
+                    time.sleep(interval)
+                    comm.send(time.time(), dest=0, tag=0)
+                comm.send(None, dest=0, tag=0)
+            elif comm.Get_rank() == 0:
+                queue = _Queue()
+                if threaded is None:
+                    stats = spin_loop(queue)
+                    label = name + ':'
+                else:
+                    driver = AsyncMasterDriver(queue, comm, threaded=threaded)
+                    asyncio.run(driver.run())
+                    stats = driver.stats()
+                    label = name + (':' if driver.threaded == threaded else ' (no MPI_THREAD_MULTIPLE):')
+                if stray:
+                    comm.recv(source=1, tag=1)
+                    label = 'unconsumed ' + label
+                latency = sorted(queue.latency)
+                print("%-34s cpu %.2f s / wall %.2f s (%3.0f%%)  wakeups %8d  latency mean %.2f ms  p99 %.2f ms" %
+                      (label, stats['cpu_time'], stats['wall_time'], 100 * stats['cpu_time'] / stats['wall_time'],
+                       stats['wakeups'], 1e3 * sum(latency) / len(latency),
+                       1e3 * latency[int(0.99 * (len(latency) - 1))]))
+            comm.Barrier()
+
+
+if __name__ == '__main__':
+    benchmark()
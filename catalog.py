@@ -0,0 +1,323 @@
+#Columnar catalog of the nodes holding the chunks and key fragments of every block, replicated on the leaders
+__all__=['MetadataCatalog', 'KIND_CHUNK', 'KIND_FRAGMENT']
+
+import time
+
+import numpy as np
+
+from keystore import KIND_CHUNK, KIND_FRAGMENT
+
+NO_NODE = -1
+
+
+class MetadataCatalog:
+    """
+    (block id, kind, index) -> node ids holding the chunk or key fragment.
+
+    The holders are one int32 matrix (a row per chunk or fragment, a column
+    per copy, NO_NODE padding) of codes into the node id table, so a row
+    costs width*4 bytes whatever the ids. The rows of a (block, kind) are
+    inserted together and stay contiguous: a dict gives their first row,
+    lookups are O(1), a block's holders are one slice.
+
+    Every insert is a new version appended to a log in row order, so a
+    replica catches up with the inserts after its version (delta/apply, or
+    sync over MPI). Inserting a (block, kind) again overwrites its rows in
+    place. With max_rows, the oldest blocks are evicted when the catalog is
+    full (their holders can still be computed by the placement), so memory
+    stays bounded; replicas apply the same bound. The replicas live on the
+    leaders: the primary only keeps the version each leader was last sent
+    (leader_delta), so a leader elected again for another block only
+    receives the inserts it missed
+    """
+
+    KIND_CHUNK    = KIND_CHUNK
+    KIND_FRAGMENT = KIND_FRAGMENT
+
+    def __init__(self, width=4, max_rows=None, capacity=1024):
+        self.width     = width
+        self.max_rows  = max_rows
+        self.holders   = np.full((capacity, width), NO_NODE, dtype=np.int32)
+        self.rows      = 0       # rows in use
+        self.row_base  = 0       # rows evicted so far: global row g is holders[g - row_base]
+        self.where     = {}      # (block, kind) -> (first global row, count, version)
+        self.log       = []      # (block, kind, first global row, count, rows appended) of version log_base + i
+        self.log_base  = 0
+        self.node_ids  = []      # node code -> node id
+        self.node_code = {}
+        self.cursors   = {}      # leader id -> (version, known nodes) last sent by leader_delta
+        # statistics
+        self.inserts   = 0
+        self.lookups   = 0
+        self.evicted   = 0
+        self.seconds   = 0.0
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def version(self):
+        return self.log_base + len(self.log)
+
+    def replica(self):
+        """
+        Empty catalog with the same bounds, brought up to date by sync_from
+        """
+        return MetadataCatalog(self.width, self.max_rows)
+
+    def leader_delta(self, leader_id, reset=False):
+        """
+        Delta of what a leader misses since the last one sent to it (all of
+        the catalog the first time, or with reset, e.g. for a leader that
+        lost its replica), then move its cursor to the current version
+        """
+        since, known = (0, 0) if reset else self.cursors.get(leader_id, (0, 0))
+        self.cursors[leader_id] = (self.version, len(self.node_ids))
+        return self.delta(since, known)
+
+    def __widen(self, width):
+        wider = np.full((len(self.holders), width), NO_NODE, dtype=np.int32)
+        wider[:, :self.width] = self.holders
+        self.holders = wider
+        self.width   = width
+
+    def __evict(self, needed):
+        # drop the oldest blocks down to 3/4 of max_rows, so the rows are moved once per max_rows/4 inserts
+        target = min(self.max_rows - needed, self.max_rows * 3 // 4)
+        drop = done = 0
+        while self.rows - drop > target:
+            block, kind, first, _, appended = self.log[done]
+            if appended and self.where.get((block, kind), (None,))[0] == first:
+                del self.where[(block, kind)]
+            drop += appended
+            done += 1
+        self.holders[:self.rows - drop] = self.holders[drop:self.rows]
+        self.rows     -= drop
+        self.row_base += drop
+        self.log       = self.log[done:]
+        self.log_base += done
+        self.evicted  += done
+
+    def __reserve(self, m):
+        if self.max_rows is not None:
+            if m > self.max_rows:
+                raise ValueError("%d rows inserted at once, max_rows is %d" % (m, self.max_rows))
+            if self.rows + m > self.max_rows:
+                self.__evict(m)
+        if self.rows + m > len(self.holders):
+            capacity = max(2 * len(self.holders), self.rows + m)
+            if self.max_rows is not None:
+                capacity = min(capacity, self.max_rows)
+            grown = np.full((capacity, self.width), NO_NODE, dtype=np.int32)
+            grown[:self.rows] = self.holders[:self.rows]
+            self.holders = grown
+
+    def __code(self, node_id):
+        code = self.node_code.get(node_id)
+        if code is None:
+            code = self.node_code[node_id] = len(self.node_ids)
+            self.node_ids.append(node_id)
+        return code
+
+    def __put(self, block, kind, codes):
+        m = len(codes)
+        if codes.shape[1] > self.width:
+            self.__widen(codes.shape[1])
+        old = self.where.get((block, kind))
+        if old is not None and m <= old[1]:
+            # placed again: overwrite its rows in place (the rows past m stay blank until evicted)
+            first, appended = old[0], 0
+            rows = self.holders[first - self.row_base:first - self.row_base + old[1]]
+        else:
+            if old is not None:
+                # more rows than before: the old rows are blanked and reclaimed by the eviction
+                start = old[0] - self.row_base
+                self.holders[start:start + old[1]] = NO_NODE
+            self.__reserve(m)
+            first, appended = self.row_base + self.rows, m
+            rows = self.holders[self.rows:self.rows + m]
+        rows[:] = NO_NODE
+        rows[:m, :codes.shape[1]] = codes
+        self.where[(block, kind)] = (first, m, self.version)
+        self.log.append((block, kind, first, m, appended))
+        self.rows    += appended
+        self.inserts += 1
+
+    def insert(self, block, kind, holders):
+        """
+        Record the holders (a list of node id lists, one per index) of all
+        the chunks or key fragments of a block. Inserting a (block, kind)
+        again overwrites its holders in place
+        """
+        start   = time.perf_counter()
+        lengths = np.fromiter((len(nodes) for nodes in holders), dtype=np.int64, count=len(holders))
+        width   = int(lengths.max()) if len(lengths) else 0
+        codes   = np.full((len(holders), width), NO_NODE, dtype=np.int32)
+        codes[np.arange(width) < lengths[:, None]] = [self.__code(node) for nodes in holders for node in nodes]
+        self.__put(block, kind, codes)
+        self.seconds += time.perf_counter() - start
+
+    def __rows(self, block, kind):
+        first, count, _ = self.where[(block, kind)]
+        start = first - self.row_base
+        return self.holders[start:start + count]
+
+    def lookup(self, block, kind, index):
+        """
+        Node ids holding chunk (or fragment) index of block, KeyError if it
+        is not in the catalog
+        """
+        self.lookups += 1
+        rows = self.__rows(block, kind)
+        if not 0 <= index < len(rows):
+            raise KeyError((block, kind, index))
+        return [self.node_ids[code] for code in rows[index].tolist() if code != NO_NODE]
+
+    def block_holders(self, block, kind):
+        """
+        Node ids holding every chunk (or fragment) of block, in index order
+        """
+        self.lookups += 1
+        return [[self.node_ids[code] for code in row if code != NO_NODE]
+                for row in self.__rows(block, kind).tolist()]
+
+    def __contains__(self, block_kind):
+        return block_kind in self.where
+
+    def items_on_node(self, node_id):
+        """
+        (block, kind, index) of everything a node holds, e.g. to copy them
+        elsewhere when it leaves: one vectorized scan of the holders
+        """
+        code = self.node_code.get(node_id)
+        if code is None:
+            return []
+        rows   = np.nonzero((self.holders[:self.rows] == code).any(axis=1))[0] + self.row_base
+        live   = sorted((first, count, block, kind) for (block, kind), (first, count, _) in self.where.items())
+        starts = np.fromiter((first for first, _, _, _ in live), dtype=np.int64, count=len(live))
+        owner  = np.searchsorted(starts, rows, side='right') - 1
+        items  = []
+        for row, k in zip(rows.tolist(), owner.tolist()):
+            first, count, block, kind = live[k]
+            if row - first < count:
+                items.append((block, kind, row - first))
+        return items
+
+    def delta(self, since=0, known_nodes=0):
+        """
+        What a replica at version since, knowing the first known_nodes node
+        ids, misses: the inserts after since and their rows
+        """
+        skip    = max(since - self.log_base, 0)
+        entries = []
+        rows    = []
+        for block, kind, first, count, _ in self.log[skip:]:
+            start = first - self.row_base
+            if start < 0:
+                # overwrite of rows evicted since: only the version is sent
+                entries.append((block, kind, None))
+                continue
+            entries.append((block, kind, count))
+            rows.append(self.holders[start:start + count])
+        return {'version': self.log_base + skip,
+                'entries': entries,
+                'holders': np.concatenate(rows) if rows else np.empty((0, self.width), dtype=np.int32),
+                'known_nodes': known_nodes,
+                'nodes': self.node_ids[known_nodes:]}
+
+    def apply(self, delta):
+        """
+        Replay a delta of the primary catalog on this replica
+        """
+        new_nodes = delta['nodes'][len(self.node_ids) - delta['known_nodes']:]
+        for node in new_nodes:
+            self.__code(node)
+        if self.version < delta['version']:
+            # the versions in between were evicted on the primary before this replica saw them
+            self.log_base += delta['version'] - self.version
+        row = 0
+        for v, (block, kind, count) in enumerate(delta['entries'], delta['version']):
+            if count is None:
+                if v >= self.version:
+                    self.log.append((block, kind, -1, 0, 0))   # no rows, sent on as a version only
+                continue
+            if v >= self.version:
+                self.__put(block, kind, delta['holders'][row:row + count])
+            row += count
+
+    def sync_from(self, primary):
+        self.apply(primary.delta(self.version, len(self.node_ids)))
+
+    def sync(self, comm, root=0):
+        """
+        Collective: bring the catalogs of all the ranks up to the root's
+        with one broadcast of what the most outdated rank misses
+        """
+        from mpi4py import MPI
+        since = comm.allreduce(self.version, op=MPI.MIN)
+        known = comm.allreduce(len(self.node_ids), op=MPI.MIN)
+        delta = comm.bcast(self.delta(since, known) if comm.Get_rank() == root else None, root=root)
+        if comm.Get_rank() != root:
+            self.apply(delta)
+
+    def nbytes(self):
+        return self.holders[:self.rows].nbytes
+
+    def stats(self):
+        return {'blocks': len(self.where),
+                'rows': self.rows,
+                'version': self.version,
+                'nbytes': self.nbytes(),
+                'inserts': self.inserts,
+                'lookups': self.lookups,
+                'evicted_blocks': self.evicted,
+                'insert_seconds': self.seconds}
+
+
+def benchmark(blocks=20000, chunks=64, fragments=4, r=3, nodes=1000, max_rows=None):
+    """
+    Insert the holders of blocks blocks, look them up, sync a replica, and
+    compare the memory with a dict of (block, kind, index) -> node list
+    """
+    import random
+    import sys
+    catalog = MetadataCatalog(width=r, max_rows=max_rows)
+    rng     = random.Random(1)
+    layout  = [[[rng.randrange(nodes) for _ in range(r)] for _ in range(chunks)] for _ in range(16)]
+    start = time.perf_counter()
+    for b in range(blocks):
+        catalog.insert(b, KIND_FRAGMENT, layout[b % 16][:fragments])
+        catalog.insert(b, KIND_CHUNK, layout[(b + 1) % 16])
+    insert = time.perf_counter() - start
+    first = blocks - len(catalog.where) // 2
+    probes = [(rng.randrange(first, blocks), rng.randrange(chunks)) for _ in range(100000)]
+    start = time.perf_counter()
+    for b, i in probes:
+        catalog.lookup(b, KIND_CHUNK, i)
+    lookup = (time.perf_counter() - start) / len(probes)
+    replica = catalog.replica()
+    start = time.perf_counter()
+    replica.sync_from(catalog)
+    full = time.perf_counter() - start
+    catalog.insert(blocks, KIND_CHUNK, layout[0])
+    start = time.perf_counter()
+    replica.sync_from(catalog)
+    incremental = time.perf_counter() - start
+    assert replica.block_holders(blocks, KIND_CHUNK) == layout[0] and replica.stats()['rows'] == catalog.rows
+    # the dict it replaces, for a sample of blocks
+    sample = min(blocks, 2000)
+    as_dict = {(b, KIND_CHUNK, i): list(nodes) for b in range(sample) for i, nodes in enumerate(layout[b % 16])}
+    dict_bytes = sys.getsizeof(as_dict) + sum(sys.getsizeof(k) + sys.getsizeof(v) + 28 * len(v)
+                                              for k, v in as_dict.items())
+    rows = catalog.rows
+    print("%d rows (%d blocks kept, %d evicted): insert %.2f us/row, lookup %.2f us" %
+          (rows, len(catalog.where) // 2, catalog.evicted // 2, insert / (blocks * (chunks + fragments)) * 1e6,
+           lookup * 1e6))
+    print("memory %.1f bytes/row (dict of lists: ~%.1f bytes/row)" %
+          (catalog.nbytes() / rows, dict_bytes / len(as_dict)))
+    print("replica sync: full %.3f s, one new block %.1f us" % (full, incremental * 1e6))
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark(max_rows=1 << 20)
@@ -0,0 +1,222 @@
+#Streaming AES encryption of the chunks of a data block into a preallocated buffer
+__all__=['ChunkCipher', 'EncryptedBlock', 'chunk_views', 'seal_chunk', 'open_chunk']
+
+import os
+import struct
+import time
+
+from Crypto.Cipher import AES
+
+TAG_LEN   = 16
+NONCE_LEN = 8    # random part of the nonce, drawn once per block
+MODES     = ('ctr', 'gcm')
+RECORD    = struct.Struct('<BBIIQ')   # mode, nonce, chunk size, tags and data lengths
+
+
+def chunk_views(data, chunk_size):
+    """
+    Zero-copy views of the consecutive chunk_size slices of data (bytes,
+    bytearray, memoryview, mmap or any contiguous buffer)
+    """
+    view = memoryview(data).cast('B')
+    return [view[off:off + chunk_size] for off in range(0, len(view), chunk_size)]
+
+
+def _cipher(key, mode, nonce, index, chunk_size):
+    """
+    Cipher object of chunk index. In CTR mode the counter of chunk index
+    starts where the one of chunk index-1 ends, so encrypting every chunk
+    separately gives the same bytes as encrypting the whole block at once.
+    In GCM mode every chunk has its own nonce (block nonce + chunk index)
+    and tag
+    """
+    if mode == 'ctr':
+        return AES.new(key, AES.MODE_CTR, nonce=nonce,
+                       initial_value=index * (chunk_size // AES.block_size))
+    return AES.new(key, AES.MODE_GCM, nonce=nonce + struct.pack('>I', index))
+
+
+def seal_chunk(key, mode, nonce, index, chunk_size, src, dst):
+    """
+    Encrypt the chunk number index of a block from src into dst, return its
+    GCM tag (None in CTR mode)
+    """
+    cipher = _cipher(key, mode, nonce, index, chunk_size)
+    cipher.encrypt(src, output=dst)
+    return cipher.digest() if mode == 'gcm' else None
+
+
+def open_chunk(key, mode, nonce, index, chunk_size, src, dst, tag=None):
+    """
+    Decrypt the chunk number index of a block from src into dst. In GCM
+    mode a wrong tag raises ValueError
+    """
+    cipher = _cipher(key, mode, nonce, index, chunk_size)
+    cipher.decrypt(src, output=dst)
+    if mode == 'gcm':
+        cipher.verify(tag)
+
+
+class EncryptedBlock:
+    """
+    Ciphertext of a block (same length as the plaintext) with what is
+    needed to decrypt any of its chunks: mode, nonce, chunk size and the
+    GCM tags of the chunks
+    """
+    __slots__ = ('mode', 'nonce', 'chunk_size', 'tags', 'data')
+
+    def __init__(self, mode, nonce, chunk_size, tags, data):
+        self.mode       = mode
+        self.nonce      = nonce
+        self.chunk_size = chunk_size
+        self.tags       = tags    # bytearray of TAG_LEN bytes per chunk, None in CTR mode
+        self.data       = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def tag(self, index):
+        if self.tags is None:
+            return None
+        return bytes(self.tags[index * TAG_LEN:(index + 1) * TAG_LEN])
+
+    def chunks(self):
+        return chunk_views(self.data, self.chunk_size)
+
+    def to_bytes(self):
+        """
+        The whole record to send or store: a header, the nonce, the tags and
+        the ciphertext
+        """
+        tags = self.tags or b''
+        return b''.join((RECORD.pack(MODES.index(self.mode), len(self.nonce), self.chunk_size,
+                                     len(tags), len(self.data)),
+                         self.nonce, tags, self.data))
+
+    @classmethod
+    def from_bytes(cls, record):
+        mode, nonce_len, chunk_size, tags_len, data_len = RECORD.unpack_from(record)
+        view  = memoryview(record)[RECORD.size:]
+        if len(view) != nonce_len + tags_len + data_len:
+            raise ValueError("truncated encrypted block record")
+        nonce = bytes(view[:nonce_len])
+        tags  = bytearray(view[nonce_len:nonce_len + tags_len]) if MODES[mode] == 'gcm' else None
+        return cls(MODES[mode], nonce, chunk_size, tags, view[nonce_len + tags_len:])
+
+
+class ChunkCipher:
+    """
+    Encrypt a whole block chunk by chunk with one key, without copying: the
+    chunks are views of the input and every chunk is encrypted straight
+    into its slice of the output buffer. In CTR mode a single cipher object
+    is used for the whole block; GCM needs one cipher object per chunk (a
+    GCM object cannot be reused with another nonce)
+    """
+
+    def __init__(self, key, mode='gcm', chunk_size=1 << 20):
+        if mode not in ('ctr', 'gcm'):
+            raise ValueError("mode must be 'ctr' or 'gcm'")
+        if chunk_size <= 0 or chunk_size % AES.block_size:
+            raise ValueError("chunk size must be a multiple of the AES block size")
+        self.key        = key
+        self.mode       = mode
+        self.chunk_size = chunk_size
+        # statistics
+        self.bytes      = 0
+        self.seconds    = 0.0
+        self.cpu        = 0.0
+
+    def __output(self, n, out):
+        if out is None:
+            out = bytearray(n)
+        dst = memoryview(out).cast('B')
+        if len(dst) < n:
+            raise ValueError("output buffer too small")
+        return out, dst[:n]
+
+    def encrypt(self, data, out=None, nonce=None):
+        """
+        Encrypt data into out (allocated when None), return an EncryptedBlock
+        over the n bytes written, not the rest of a larger out
+        """
+        start, cpu = time.perf_counter(), time.thread_time()
+        src = memoryview(data).cast('B')
+        n   = len(src)
+        allocated = out is None
+        out, dst = self.__output(n, out)
+        nonce = os.urandom(NONCE_LEN) if nonce is None else nonce
+        cs  = self.chunk_size
+        if self.mode == 'ctr':
+            tags = None
+            cipher = _cipher(self.key, 'ctr', nonce, 0, cs)
+            for off in range(0, n, cs):
+                cipher.encrypt(src[off:off + cs], output=dst[off:off + cs])
+        else:
+            tags = bytearray(-(-n // cs) * TAG_LEN)
+            for i, off in enumerate(range(0, n, cs)):
+                tags[i * TAG_LEN:(i + 1) * TAG_LEN] = \
+                    seal_chunk(self.key, 'gcm', nonce, i, cs, src[off:off + cs], dst[off:off + cs])
+        self.bytes   += n
+        self.seconds += time.perf_counter() - start
+        self.cpu     += time.thread_time() - cpu
+        return EncryptedBlock(self.mode, nonce, cs, tags, out if allocated else dst)
+
+    def decrypt_chunk(self, block, index, out=None):
+        """
+        Decrypt the chunk number index of an EncryptedBlock alone
+        """
+        src = chunk_views(block.data, block.chunk_size)[index]
+        out, dst = self.__output(len(src), out)
+        open_chunk(self.key, block.mode, block.nonce, index, block.chunk_size,
+                   src, dst, block.tag(index))
+        return out
+
+    def decrypt(self, block, out=None):
+        """
+        Decrypt a whole EncryptedBlock into out (allocated when None)
+        """
+        src = memoryview(block.data).cast('B')
+        out, dst = self.__output(len(src), out)
+        cs = block.chunk_size
+        for i, off in enumerate(range(0, len(src), cs)):
+            open_chunk(self.key, block.mode, block.nonce, i, cs,
+                       src[off:off + cs], dst[off:off + cs], block.tag(i))
+        return out
+
+    def stats(self):
+        return {'bytes': self.bytes,
+                'seconds': self.seconds,
+                'MB/s': self.bytes / self.seconds / 1e6 if self.seconds else None,
+                'MB/s per core': self.bytes / self.cpu / 1e6 if self.cpu else None}
+
+
+def benchmark(size=64 << 20, chunk_sizes=(4 << 10, 64 << 10, 1 << 20)):
+    """
+    Encrypt a size bytes block with the per-chunk CBC of key-dist.py
+    (AES.new, pad and iv + ciphertext per chunk) and with ChunkCipher in CTR
+    and GCM mode, reusing the same output buffer
+    """
+    from Crypto.Util.Padding import pad
+    key   = os.urandom(16)
+    block = os.urandom(size)
+    out   = bytearray(size)
+    for cs in chunk_sizes:
+        start, cpu = time.perf_counter(), time.thread_time()
+        view = memoryview(block)
+        for off in range(0, size, cs):
+            cipher = AES.new(key, AES.MODE_CBC)
+            cipher.iv + cipher.encrypt(pad(bytes(view[off:off + cs]), AES.block_size))
+        seconds, cpu = time.perf_counter() - start, time.thread_time() - cpu
+        print("chunk %7d  %-18s %8.1f MB/s  %8.1f MB/s per core" %
+              (cs, 'CBC + pad per chunk', size / seconds / 1e6, size / cpu / 1e6))
+        for mode in ('ctr', 'gcm'):
+            engine = ChunkCipher(key, mode, cs)
+            sealed = engine.encrypt(block, out)
+            stats  = engine.stats()
+            print("chunk %7d  %-18s %8.1f MB/s  %8.1f MB/s per core" %
+                  (cs, 'ChunkCipher ' + mode, stats['MB/s'], stats['MB/s per core']))
+            assert engine.decrypt(sealed) == block
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,92 @@
+#Reed-Solomon k-of-n erasure coding of encrypted chunks over GF(256)
+__all__=['ReedSolomon']
+
+import numpy as np
+
+from gf256 import gf_inv_matrix, gf_matmul, gf_pow
+
+
+class ReedSolomon:
+    """
+    Systematic Reed-Solomon code: a chunk is cut into k data shards and
+    n-k parity shards are added, any k of the n shards rebuild the chunk.
+    Storing the n shards on n distinct nodes tolerates the loss of n-k
+    nodes for n/k times the chunk size, where replication needs n-k+1
+    full copies. The encoding matrix is a Vandermonde matrix made
+    systematic (its first k rows are the identity)
+    """
+
+    def __init__(self, k, n):
+        if not 0 < k <= n <= 255:
+            raise ValueError("need 0 < k <= n <= 255")
+        self.k = k
+        self.n = n
+        vandermonde = np.array([[gf_pow(x, j) for j in range(k)] for x in range(n)], dtype=np.uint8)
+        self.matrix = gf_matmul(vandermonde, gf_inv_matrix(vandermonde[:k]))
+        self.decoders = {}   # tuple of k shard indices -> decoding matrix
+
+    def shard_size(self, length):
+        return -(-length // self.k)
+
+    def encode(self, data):
+        """
+        n shards (rows of a (n, shard_size) uint8 array) of data
+        """
+        view = np.frombuffer(memoryview(data).cast('B'), dtype=np.uint8)
+        size = self.shard_size(len(view))
+        shards = np.zeros((self.n, size), dtype=np.uint8)
+        flat = shards[:self.k].reshape(-1)
+        flat[:len(view)] = view   # the data shards are the chunk itself, zero padded
+        if self.n > self.k:
+            shards[self.k:] = gf_matmul(self.matrix[self.k:], shards[:self.k])
+        return shards
+
+    def decode(self, shards, length):
+        """
+        Rebuild the length bytes of a chunk from {shard index: shard} with
+        at least k entries
+        """
+        if len(shards) < self.k:
+            raise ValueError("%d shards, %d needed" % (len(shards), self.k))
+        indices = tuple(sorted(shards)[:self.k])
+        rows = np.stack([np.frombuffer(memoryview(shards[i]).cast('B'), dtype=np.uint8)
+                         for i in indices])
+        if indices != tuple(range(self.k)):
+            decoder = self.decoders.get(indices)
+            if decoder is None:
+                decoder = self.decoders[indices] = gf_inv_matrix(self.matrix[list(indices)])
+            rows = gf_matmul(decoder, rows)
+        return rows.reshape(-1)[:length].tobytes()
+
+
+def compare(size=1 << 20, faults=(1, 2, 3), repeat=5):
+    """
+    For the same number of tolerated node losses f, compare r=f+1 fold
+    replication with RS(k, k+f): bytes sent and stored per chunk, encoding
+    time, and rebuild time when f data shards are lost
+    """
+    import os
+    import time
+    data = os.urandom(size)
+    print("%d bytes chunk" % size)
+    for f in faults:
+        print("f=%d  replication r=%d: %5.2fx bytes on the wire and stored, rebuild = read a copy" %
+              (f, f + 1, f + 1))
+        for k in (4, 8, 16):
+            rs = ReedSolomon(k, k + f)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                shards = rs.encode(data)
+            encode = (time.perf_counter() - start) / repeat
+            survivors = {i: shards[i] for i in range(f, k + f)}   # the first f data shards lost
+            start = time.perf_counter()
+            for _ in range(repeat):
+                rebuilt = rs.decode(survivors, size)
+            decode = (time.perf_counter() - start) / repeat
+            assert rebuilt == data
+            print("      RS(%2d,%2d): %5.2fx bytes, encode %7.1f MB/s, rebuild %7.1f MB/s" %
+                  (k, k + f, shards.nbytes / size, size / encode / 1e6, size / decode / 1e6))
+
+
+if __name__ == '__main__':
+    compare()
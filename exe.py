@@ -3,15 +3,28 @@ import random
 import math
 import time
 from concurrent.futures import ThreadPoolExecutor
+from block_stream import BlockStreamer, prefetch
+from two_phase import TwoPhaseCommit
 from ztp_consensus import ZTPConsensus
 from ztp_key_data_accumulation import ZTPKeyDataAccumulation
 from ztp_quorum import ZTPQuorum
 
 # Define helper functions (e.g., for key and data distribution)
-def generate_aes_key(block):
+def generate_aes_key(block_id, key_deriver=None, key_pool=None):
+    # With a key_derivation.KeyDeriver the key is derived from the block id, nothing to store or send
+    if key_deriver is not None:
+        if block_id is None:
+            raise ValueError("a block id (sequence number or file offset) is needed to derive the block key")
+        return key_deriver.block_key(block_id)
+    # With a key_pool.KeyPool the key was generated ahead of time by its refill thread
+    if key_pool is not None:
+        return key_pool.get()
     return bytes(random.getrandbits(8) for _ in range(32))  # 256-bit key
 
-def fragment_key(aes_key, shape):
+def fragment_key(aes_key, shape, shamir=None):
+    # With a shamir.Shamir the fragments are the n shares of the whole key, any t of them rebuild it
+    if shamir is not None:
+        return shamir.split_key(aes_key)
     num_fragments = 4  # Assume the shape dictates the number of fragments
     return [aes_key[i:i+8] for i in range(0, len(aes_key), 8)]
 
@@ -54,83 +67,74 @@ def generate_identifiers(fragments):
 def select_nodes_for_key(fragment, redundancy, leaders):
     return random.sample(leaders, redundancy)
 
-def distribute_fragment(fragment, nodes):
+def select_nodes_for_shares(n, leaders, leader_placement=None, block_id=None):
     """
-    Implementing the 2-phase commit protocol for distributing key fragments to nodes.
+    One distinct leader per Shamir share, all n chosen at once: two shares on the same node
+    would let it rebuild the key alone with t=2.
     """
-    # Phase 1: Prepare
-    print(f"Phase 1: Prepare - Sending prepare request to nodes: {nodes}")
-    
-    # Collect responses from nodes
-    responses = {}
-    with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-        futures = {executor.submit(self.send_prepare_request, node, fragment): node for node in nodes}
-        for future in futures:
-            node = futures[future]
-            try:
-                response = future.result()
-                responses[node] = response
-                print(f"Node {node} response: {response}")
-            except Exception as e:
-                responses[node] = "no"
-                print(f"Failed to get response from node {node}: {e}")
-
-    # Check if all responses are "yes"
-    if all(response == "yes" for response in responses.values()):
-        # Phase 2: Commit
-        print("Phase 2: Commit - All nodes are ready. Sending commit request.")
-        with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-            futures = {executor.submit(self.send_commit_request, node, fragment): node for node in nodes}
-            for future in futures:
-                node = futures[future]
-                try:
-                    future.result()  # Ensures the node has received the commit request
-                    print(f"Node {node} committed to storing fragment.")
-                except Exception as e:
-                    print(f"Failed to commit fragment to node {node}: {e}")
-    else:
-        # Phase 2: Rollback
-        print("Phase 2: Rollback - Not all nodes are ready. Sending rollback request.")
-        with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-            futures = {executor.submit(self.send_rollback_request, node, fragment): node for node in nodes}
-            for future in futures:
-                node = futures[future]
-                try:
-                    future.result()  # Ensures the node has received the rollback request
-                    print(f"Node {node} rolled back the fragment distribution.")
-                except Exception as e:
-                    print(f"Failed to send rollback to node {node}: {e}")
-    
-    # Final status
-    print("Fragment distribution process completed.")
+    if len(leaders) < n:
+        raise ValueError(f"{n} Shamir shares need {n} distinct leaders, {len(leaders)} available")
+    if leader_placement is not None:
+        return [[node] for node in leader_placement.holders(('shares', block_id), n)]
+    return [[node] for node in random.sample(leaders, n)]
 
-def send_prepare_request(self, node, fragment):
+def send_prepare_request(node, fragments):
     """
-    Simulate sending a prepare request to a node. The node either accepts or rejects based on availability.
+    Simulate sending a prepare request to a node for all the (fragment id, fragment) it is asked
+    to store, in one round trip. The node accepts or rejects each fragment based on availability.
     """
     # Simulating the node's decision to accept or reject the fragment distribution
     time.sleep(random.uniform(0.1, 0.3))  # Simulate some delay
-    decision = "yes" if random.random() > 0.1 else "no"  # 90% chance to accept
-    return decision
+    return ["yes" if random.random() > 0.1 else "no" for _ in fragments]  # 90% chance to accept
 
-def send_commit_request(self, node, fragment):
+def send_commit_request(node, fragment_ids):
     """
-    Simulate sending a commit request to a node to store the fragment.
+    Simulate sending a commit request to a node to store the fragments.
     """
     time.sleep(random.uniform(0.1, 0.3))  # Simulate some delay
-    print(f"Node {node} is committing the fragment.")
+    print(f"Node {node} is committing fragments {fragment_ids}.")
 
-def send_rollback_request(self, node, fragment):
+def send_rollback_request(node, fragment_ids):
     """
-    Simulate sending a rollback request to a node to discard the fragment.
+    Simulate sending a rollback request to a node to discard the fragments.
     """
     time.sleep(random.uniform(0.1, 0.3))  # Simulate some delay
-    print(f"Node {node} is rolling back the fragment.")
+    print(f"Node {node} is rolling back fragments {fragment_ids}.")
+
+def distribute_fragments(fragments, fragment_commit):
+    """
+    Implementing the 2-phase commit protocol for distributing key fragments to nodes.
+    fragment_commit is the TwoPhaseCommit (and its executor) of the contract.
+    fragments is a list of (fragment id, fragment, nodes), of one block or of many blocks:
+    every node gets a single prepare request, then a single commit and/or rollback request,
+    for all its fragments, so the distribution takes one round trip per phase.
+    Return {fragment id: True if committed on all its nodes, False if rolled back}.
+    """
+    nodes = sorted(set(node for _, _, holders in fragments for node in holders))
+    print(f"Phase 1: Prepare - Sending prepare requests for {len(fragments)} fragments to nodes: {nodes}")
+    committed = fragment_commit.distribute(fragments)
+    rolled_back = [fragment_id for fragment_id, ok in committed.items() if not ok]
+    print(f"Phase 2: Commit - {len(committed) - len(rolled_back)} fragments committed, "
+          f"rolled back: {rolled_back}")
+
+    # Final status
+    print("Fragment distribution process completed.")
+    return committed
+
+def distribute_fragment(fragment, nodes, fragment_commit):
+    """
+    Two-phase commit of a single fragment, True if it was committed.
+    """
+    return distribute_fragments([(0, fragment, nodes)], fragment_commit)[0]
 
 def split_block(block, chunk_size):
     return [block[i:i+chunk_size] for i in range(0, len(block), chunk_size)]
 
-def generate_chunk_key(chunk):
+def generate_chunk_key(chunk, block_id=None, index=None, key_deriver=None):
+    if key_deriver is not None:
+        if block_id is None or index is None:
+            raise ValueError("a block id and a chunk index are needed to derive the chunk key")
+        return key_deriver.chunk_key(block_id, index)
     return bytes(random.getrandbits(8) for _ in range(32))  # 256-bit key for chunk
 
 def encrypt_chunk(chunk, chunk_key):
@@ -147,8 +151,18 @@ def record_metadata(leaders, fragments_or_chunks):
 
 # Updated ZTPSmartContract class integrating Key and Data Fragmentation
 class ZTPSmartContract:
-    def __init__(self):
+    def __init__(self, key_deriver=None, key_pool=None, data_plane=None, placement=None, shamir=None,
+                 catalog=None):
         self.nodes = []  # Placeholder for nodes in the network
+        self.key_deriver = key_deriver  # Optional KeyDeriver for stateless block/chunk keys
+        self.key_pool = key_pool  # Optional KeyPool of 32 bytes keys generated in the background
+        self.data_plane = data_plane  # Optional DataPlane: node_i is hosted by MPI rank i % size
+        self.placement = placement  # Optional Placement: holders computed from the block id and index
+        self.shamir = shamir  # Optional Shamir: one key share per node instead of r copies of each fragment
+        self.catalog = catalog  # Optional MetadataCatalog: holders of every chunk and fragment by block and index
+        self.next_block_id = 0  # Sequence number given to the blocks distributed without a block id
+        # One executor runs the two-phase commits of every block of the contract, shut down by close()
+        self.fragment_commit = TwoPhaseCommit(send_prepare_request, send_commit_request, send_rollback_request)
         self.block = ""  # Placeholder for the data block
         self.shape = ""  # Placeholder for the shape of fragmentation
         self.chunk_size = 0  # Placeholder for the chunk size
@@ -177,20 +191,25 @@ class ZTPSmartContract:
         print(f"Selected leaders: {leaders}")
         return elected_nodes, leaders
     
-    def parallel_data_key_distribution(self, block, s, c, r, P):
+    def parallel_data_key_distribution(self, block, s, c, r, P, block_id=None):
         """
         Function to simulate parallel data and key distribution across blockchain nodes.
+        block_id identifies the block (a sequence number or file offset, never its content);
+        without one the block gets the next sequence number.
         """
-        print(f"Running Parallel Data and Key Distribution for block {block}...")
+        if block_id is None:
+            block_id = self.next_block_id
+            self.next_block_id += 1
+        print(f"Running Parallel Data and Key Distribution for block {block_id}...")
         
         # 1. Run quorum election and leader selection
         elected_nodes, leaders = self.quorum_election_and_leader_selection()
         
         # 2. Generate AES key for the block
-        aes_key = generate_aes_key(block)
+        aes_key = generate_aes_key(block_id, self.key_deriver, self.key_pool)
         
         # 3. Fragment the AES key into parts based on shape
-        key_fragments = fragment_key(aes_key, s)
+        key_fragments = fragment_key(aes_key, s, self.shamir)
         
         # 4. Encrypt the key fragments using ABE with the access policy
         encrypted_key_fragments = encrypt_key_with_abe(key_fragments, P)
@@ -198,58 +217,130 @@ class ZTPSmartContract:
         # 5. Generate unique identifiers for key fragments
         fragment_identifiers = generate_identifiers(key_fragments)
         
-        # 6. Distribute key fragments to nodes (based on redundancy)
-        for i, fragment in enumerate(encrypted_key_fragments):
-            selected_nodes_for_key = select_nodes_for_key(fragment, r, leaders)
-            distribute_fragment(fragment, selected_nodes_for_key)
+        # 6. Distribute key fragments to nodes (based on redundancy, n distinct nodes for the Shamir shares)
+        leader_placement = self.placement.subset(leaders) if self.placement is not None else None
+        elected_placement = self.placement.subset(elected_nodes) if self.placement is not None else None
+        key_nodes = set()  # data chunks avoid the nodes holding a key fragment of the block
+        if self.shamir is not None:
+            fragment_holders = select_nodes_for_shares(len(encrypted_key_fragments), leaders, leader_placement, block_id)
+            if leader_placement is not None:
+                key_nodes.update(node for nodes in fragment_holders for node in nodes)
+        else:
+            fragment_holders = []
+            for i, fragment in enumerate(encrypted_key_fragments):
+                if leader_placement is not None:
+                    selected_nodes_for_key = leader_placement.holders(('fragment', block_id, i), r)
+                    key_nodes.update(selected_nodes_for_key)
+                else:
+                    selected_nodes_for_key = select_nodes_for_key(fragment, r, leaders)
+                fragment_holders.append(selected_nodes_for_key)
+        # all the fragments of the block in one two-phase commit, batched per node
+        distribute_fragments([(fragment_identifiers[i], fragment, nodes)
+                              for i, (fragment, nodes) in enumerate(zip(encrypted_key_fragments, fragment_holders))],
+                             self.fragment_commit)
         
         # 7. Record metadata for key distribution
         record_metadata(leaders, fragment_identifiers)
+        if self.catalog is not None:
+            self.catalog.insert(block_id, self.catalog.KIND_FRAGMENT, fragment_holders)
         
         # 8. Split the block into smaller chunks
         data_chunks = split_block(block, c)
         
         # 9. For each chunk, generate a key and encrypt it
-        for chunk in data_chunks:
-            chunk_key = generate_chunk_key(chunk)
+        # (with a key pool, all the chunk keys of the block are taken in one batch)
+        chunk_keys = None
+        if self.key_pool is not None and self.key_deriver is None:
+            chunk_keys = self.key_pool.take(len(data_chunks))
+        outgoing = []  # (encrypted chunk, nodes) for the data plane
+        chunk_holders = []
+        for index, chunk in enumerate(data_chunks):
+            if chunk_keys is not None:
+                chunk_key = chunk_keys[index]
+            else:
+                chunk_key = generate_chunk_key(chunk, block_id, index, self.key_deriver)
             encrypted_chunk = encrypt_chunk(chunk, chunk_key)
             
-            # 10. Select nodes for storing the data chunk, ensuring no overlap with key nodes
-            selected_nodes_for_data = select_nodes_for_data(chunk, r, leaders)
-            distribute_chunk(encrypted_chunk, selected_nodes_for_data)
+            # 10. Select nodes for storing the data chunk, without overlap with key nodes
+            # (when the leaders are all key nodes, on the other elected nodes)
+            if leader_placement is not None:
+                selected_nodes_for_data = leader_placement.data_holders(('chunk', block_id, index), r, key_nodes,
+                                                                        elected_placement)
+            else:
+                selected_nodes_for_data = select_nodes_for_data(chunk, r, leaders)
+            chunk_holders.append(selected_nodes_for_data)
+            if self.data_plane is not None:
+                outgoing.append((encrypted_chunk, selected_nodes_for_data))
+            else:
+                distribute_chunk(encrypted_chunk, selected_nodes_for_data)
         
         # 11. Record metadata for chunk distribution
         record_metadata(leaders, data_chunks)
+        if self.catalog is not None:
+            self.catalog.insert(block_id, self.catalog.KIND_CHUNK, chunk_holders)
+
+        # 12. With a data plane, send all the chunks of the block with one scatter_block
+        if self.data_plane is not None:
+            self.distribute_chunks(outgoing)
         
         return data_chunks, encrypted_key_fragments, key_fragments
     
+    def distribute_chunks(self, outgoing):
+        """
+        Send the (encrypted chunk, nodes) of a block through the data plane. Collective:
+        the ranks other than the root call it with an empty list and get their chunks back.
+        With a catalog, the catalogs of the other ranks are then synced with the root's.
+        """
+        if not self.data_plane.is_root():
+            received = self.data_plane.scatter_block()
+        else:
+            items = [chunk.encode() if isinstance(chunk, str) else chunk for chunk, _ in outgoing]
+            placement = [[int(node.rsplit('_', 1)[1]) for node in nodes] for _, nodes in outgoing]
+            received = self.data_plane.scatter_block(items, list(range(len(items))), placement)
+        if self.catalog is not None:
+            self.catalog.sync(self.data_plane.comm, self.data_plane.root)
+        return received
+
     def execute(self):
         """
         Main function to execute the full ZTP Smart Contract operation.
+        The two-phase commit executor is shut down when it returns.
         """
-        self.get_available_nodes()
-        
-        # Sample data block, shape, chunk size, redundancy, and access policy
-        self.block = "This is a sample block of data to be processed by the ZTP Smart Contract."
-        self.shape = "some_shape"
-        self.chunk_size = 16
-        self.redundancy = 2
-        self.access_policy = "some_access_policy"
-        
-        distributed_data, encrypted_key_fragments, key_fragments = self.parallel_data_key_distribution(
-            self.block, self.shape, self.chunk_size, self.redundancy, self.access_policy
-        )
+        try:
+            self.get_available_nodes()
+            
+            # Sample data block, shape, chunk size, redundancy, and access policy
+            self.block = "This is a sample block of data to be processed by the ZTP Smart Contract."
+            self.shape = "some_shape"
+            self.chunk_size = 16
+            self.redundancy = 2
+            self.access_policy = "some_access_policy"
+            
+            distributed_data, encrypted_key_fragments, key_fragments = self.parallel_data_key_distribution(
+                self.block, self.shape, self.chunk_size, self.redundancy, self.access_policy
+            )
+
+            print(f"Distributed Data Chunks: {distributed_data}")
+            print(f"Encrypted Key Fragments: {encrypted_key_fragments}")
+            print(f"Original Key Fragments: {key_fragments}")
+        finally:
+            self.close()
 
-        print(f"Distributed Data Chunks: {distributed_data}")
-        print(f"Encrypted Key Fragments: {encrypted_key_fragments}")
-        print(f"Original Key Fragments: {key_fragments}")
+    def close(self):
+        """
+        Shut down the two-phase commit executor of the contract.
+        """
+        self.fragment_commit.close()
 
 # ZTP class for managing the consensus and smart contract execution
 class ZTP:
-    def __init__(self, data_blocks, transaction_file):
+    def __init__(self, data_blocks, transaction_file, block_records=65536, max_pending=2, cipher=None):
         self.nodes = self.get_available_nodes()  # Get dynamically available nodes
         self.data_blocks = data_blocks
         self.transaction_file = transaction_file
+        self.block_records = block_records  # Transactions per block streamed from the file
+        self.max_pending = max_pending  # Blocks read ahead of the distribution at most
+        self.cipher = cipher  # Optional chunk_cipher.ChunkCipher: blocks are encrypted before they are sent
         self.consensus = ZTPConsensus(self.nodes)
         self.key_data_accumulation = ZTPKeyDataAccumulation(self.nodes)
         self.smart_contract = ZTPSmartContract()
@@ -263,33 +354,46 @@ class ZTP:
     def parallel_data_key_distribution(self, block, s, c, r, P):
         """
         Simulate parallel distribution of data and keys to the nodes from a stream of transaction data.
+        block is the id of the first block of the stream, the next ones are numbered after it.
         """
         print(f"Running Parallel Data and Key Distribution for block {block}...")
-        block_data = self.create_block_from_file()
 
-        # Using ThreadPoolExecutor for parallel distribution
+        # Using ThreadPoolExecutor for parallel distribution, block after block as the file is read:
+        # the reader stays at most max_pending blocks ahead, so memory does not grow with the file
         with ThreadPoolExecutor(max_workers=4) as executor:
-            future_to_node = {executor.submit(self.distribute_block_data, block_data, node): node for node in self.nodes}
-            for future in future_to_node:
-                node = future_to_node[future]
-                try:
-                    future.result()
-                    print(f"Data successfully distributed to node {node}")
-                except Exception as e:
-                    print(f"Failed to distribute data to node {node}: {e}")
+            for block_data in self.create_block_from_file(block):
+                payload = block_data.to_bytes()
+                if self.cipher is not None:
+                    payload = self.seal_block(payload)
+                future_to_node = {executor.submit(self.distribute_block_data, payload, node): node for node in self.nodes}
+                for future in future_to_node:
+                    node = future_to_node[future]
+                    try:
+                        future.result()
+                        print(f"Data of block {block_data.bid} successfully distributed to node {node}")
+                    except Exception as e:
+                        print(f"Failed to distribute data of block {block_data.bid} to node {node}: {e}")
         return block
 
-    def create_block_from_file(self):
+    def seal_block(self, payload):
+        """
+        Encrypt a block payload into the record sent to the nodes: nonce, GCM tags and ciphertext
+        (chunk_cipher.EncryptedBlock.to_bytes, read back with EncryptedBlock.from_bytes).
+        """
+        return self.cipher.encrypt(payload).to_bytes()
+
+    def create_block_from_file(self, first_bid=0):
         """
-        Simulate creating a block from transaction data streamed from a file.
+        Create blocks from transaction data streamed from a file.
+        The file is read in large buffers by a background thread and parsed into
+        block_stream.TransactionBlock arrays of at most block_records transactions,
+        yielded as they fill (block.records() gives the process_transaction_line dicts).
+        The blocks are numbered from first_bid.
         """
-        block_data = []
-        with open(self.transaction_file, 'r') as file:
-            for line in file:
-                transaction = self.process_transaction_line(line)
-                block_data.append(transaction)
-        print(f"Block created with {len(block_data)} transactions.")
-        return block_data
+        streamer = BlockStreamer(self.transaction_file, self.block_records, first_bid=first_bid)
+        for block_data in prefetch(streamer, self.max_pending):
+            print(f"Block {block_data.bid} created with {len(block_data)} transactions.")
+            yield block_data
 
     def process_transaction_line(self, line):
         """
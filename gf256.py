@@ -0,0 +1,89 @@
+#GF(256) arithmetic on NumPy uint8 arrays with log/exp tables (polynomial 0x11d, generator 2)
+__all__=['EXP', 'LOG', 'MUL', 'INV', 'gf_mul', 'gf_div', 'gf_pow', 'gf_matmul', 'gf_inv_matrix']
+
+import numpy as np
+
+
+def _tables():
+    exp = np.zeros(512, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int64)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    exp[255:510] = exp[:255]   # EXP[LOG[a] + LOG[b]] needs no modulo
+    # full multiplication table: MUL[a] is the 256 bytes row "a times"
+    a = np.arange(256)
+    mul = exp[(log[a][:, None] + log[a][None, :])]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    inv = np.zeros(256, dtype=np.uint8)
+    inv[1:] = exp[255 - log[1:]]
+    return exp, log, mul.astype(np.uint8), inv
+
+
+EXP, LOG, MUL, INV = _tables()
+
+
+def gf_mul(a, b):
+    """
+    Element-wise product of uint8 arrays (or scalars)
+    """
+    return MUL[a, b]
+
+
+def gf_div(a, b):
+    return MUL[a, INV[b]]
+
+
+def gf_pow(a, n):
+    """
+    a**n for a scalar a
+    """
+    if n == 0:
+        return 1
+    if a == 0:
+        return 0
+    return int(EXP[(LOG[a] * n) % 255])
+
+
+def gf_matmul(a, b):
+    """
+    Product of the (m, k) matrix a with the (k, L) matrix b: every output
+    row is the XOR of k table lookups over whole rows of b
+    """
+    a = np.asarray(a, dtype=np.uint8)
+    out = np.zeros((a.shape[0], b.shape[1]), dtype=np.uint8)
+    for i in range(a.shape[0]):
+        row = out[i]
+        for j in range(a.shape[1]):
+            c = a[i, j]
+            if c == 1:
+                row ^= b[j]
+            elif c:
+                row ^= MUL[c][b[j]]
+    return out
+
+
+def gf_inv_matrix(m):
+    """
+    Inverse of a square matrix by Gauss-Jordan elimination, ValueError if
+    it is singular
+    """
+    m = np.array(m, dtype=np.uint8)
+    n = m.shape[0]
+    aug = np.concatenate((m, np.eye(n, dtype=np.uint8)), axis=1)
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if aug[r, col]), None)
+        if pivot is None:
+            raise ValueError("singular matrix")
+        if pivot != col:
+            aug[[col, pivot]] = aug[[pivot, col]]
+        aug[col] = MUL[INV[aug[col, col]]][aug[col]]
+        for r in range(n):
+            if r != col and aug[r, col]:
+                aug[r] ^= MUL[aug[r, col]][aug[col]]
+    return aug[:, n:]
@@ -0,0 +1,167 @@
+#Stateless per-block and per-chunk AES keys derived from a cluster master secret
+__all__=['KeyDeriver', 'hkdf_extract', 'hkdf_expand', 'cluster_master_secret']
+
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+
+SALT      = b'ztp-key-derivation-v1'
+HASH_LEN  = hashlib.sha256().digest_size
+
+
+def hkdf_extract(salt, ikm):
+    """
+    HKDF-Extract (RFC 5869) with HMAC-SHA256
+    """
+    return hmac.digest(salt or bytes(HASH_LEN), ikm, 'sha256')
+
+
+def hkdf_expand(prk, info, length):
+    """
+    HKDF-Expand (RFC 5869) with HMAC-SHA256
+    """
+    if length > 255 * HASH_LEN:
+        raise ValueError("HKDF output too long")
+    okm = b''
+    t   = b''
+    i   = 1
+    while len(okm) < length:
+        t = hmac.digest(prk, t + info + bytes((i,)), 'sha256')
+        okm += t
+        i += 1
+    return okm[:length]
+
+
+def _encode(parts):
+    """
+    Unambiguous encoding of the identifiers of a key into the HKDF info:
+    the repr of the tuple keeps the type of every bytes, str or int part
+    """
+    for part in parts:
+        if type(part) not in (bytes, str, int):
+            raise TypeError("key identifiers must be bytes, str or int")
+    return repr(parts).encode()
+
+
+def cluster_master_secret(comm=None, root=0):
+    """
+    Master secret shared by all the ranks of comm: drawn on root and
+    broadcast once, instead of shipping every block and chunk key
+    """
+    if comm is None:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    return comm.bcast(os.urandom(32) if comm.Get_rank() == root else None, root=root)
+
+
+class KeyDeriver:
+    """
+    Derive the AES key of a block, or of a chunk of a block, on demand from
+    the master secret and the identifiers, so that any node holding the
+    master secret gets the same key without it being stored or sent. The
+    last cache_size derived keys are kept in an LRU cache
+    """
+
+    def __init__(self, master_secret, key_len=16, cache_size=4096, salt=SALT):
+        if key_len not in (16, 24, 32):
+            raise ValueError("AES key must be 16, 24 or 32 bytes long.")
+        self.prk        = hkdf_extract(salt, master_secret)
+        self.mac        = hmac.new(self.prk, digestmod=hashlib.sha256)
+        self.key_len    = key_len
+        self.cache_size = cache_size
+        self.cache      = OrderedDict()  # HKDF info -> key
+        self.lock       = threading.Lock()
+        self.hits       = 0
+        self.misses     = 0
+
+    def derive(self, *identifiers):
+        """
+        Key of the given identifiers
+        """
+        info = _encode(identifiers)
+        with self.lock:
+            key = self.cache.get(info)
+            if key is not None:
+                self.cache.move_to_end(info)
+                self.hits += 1
+                return key
+            self.misses += 1
+        if self.key_len <= HASH_LEN:
+            # single block HKDF-Expand, from the HMAC already keyed with the PRK
+            mac = self.mac.copy()
+            mac.update(info + b'\x01')
+            key = mac.digest()[:self.key_len]
+        else:
+            key = hkdf_expand(self.prk, info, self.key_len)
+        if self.cache_size:
+            with self.lock:
+                self.cache[info] = key
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return key
+
+    def block_key(self, block_id):
+        return self.derive('block', block_id)
+
+    def chunk_key(self, block_id, chunk_id):
+        return self.derive('chunk', block_id, chunk_id)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'cached': len(self.cache),
+                'cache_size': self.cache_size}
+
+
+def benchmark(n=10**5, chunks=8, path='derivation_bench.bin'):
+    """
+    Compare deriving the keys of n blocks and of their chunks with
+    generating random keys, storing them in a keystore and looking them up
+    """
+    import time
+    import numpy as np
+    from keystore import KeyStore, key_id, write_keystore, KIND_BLOCK, KIND_CHUNK
+
+    ids = [key_id(KIND_BLOCK, b) for b in range(n)] + \
+          [key_id(KIND_CHUNK, b, c) for b in range(n) for c in range(chunks)]
+    t0 = time.perf_counter()
+    keys = np.frombuffer(os.urandom(len(ids) * 16), dtype=np.uint8).reshape(-1, 16)
+    write_keystore(path, ids, keys)
+    with KeyStore(path) as store:
+        for rid in ids:
+            store.get(rid)
+    t1 = time.perf_counter()
+    os.remove(path)
+
+    deriver = KeyDeriver(os.urandom(32), cache_size=0)
+    t2 = time.perf_counter()
+    for b in range(n):
+        deriver.block_key(b)
+        for c in range(chunks):
+            deriver.chunk_key(b, c)
+    t3 = time.perf_counter()
+
+    deriver = KeyDeriver(os.urandom(32), cache_size=4096)
+    for b in range(4096 // (chunks + 1)):
+        deriver.block_key(b)
+    t4 = time.perf_counter()
+    for _ in range(n * (chunks + 1) // 4096):
+        for b in range(4096 // (chunks + 1)):
+            deriver.block_key(b)
+    t5 = time.perf_counter()
+    cached = n * (chunks + 1) // 4096 * (4096 // (chunks + 1))
+
+    total = len(ids)
+    print("%d keys (%d blocks x (1 + %d chunks))" % (total, n, chunks))
+    print("generate + store + lookup: %8.1f ms (%.2f M keys/s)" % ((t1 - t0) * 1000, total / (t1 - t0) / 1e6))
+    print("HKDF derivation:           %8.1f ms (%.2f M keys/s)" % ((t3 - t2) * 1000, total / (t3 - t2) / 1e6))
+    print("cached derivation:         %8.1f ms (%.2f M keys/s)" % ((t5 - t4) * 1000, cached / (t5 - t4) / 1e6))
+    print("stored key bytes avoided:  %d" % keys.nbytes)
+
+
+if __name__ == '__main__':
+    benchmark()
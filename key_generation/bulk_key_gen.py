@@ -0,0 +1,66 @@
+import base64, os, sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from keystore import KeyStore, block_key_ids, write_keystore
+
+AES_KEY_LENGTHS = (16, 24, 32)  # AES key length must be either 16, 24, or 32 bytes long
+
+def current_time_ms():
+    return time.time() * 1000
+
+# Function to generate n AES keys at once
+def generate_keys_bulk(n, key_len=16):
+    # draw all the n*key_len random bytes in a single call and view them as
+    # a (n, key_len) array: row i is the i-th secret key
+    if key_len not in AES_KEY_LENGTHS:
+        raise ValueError("AES key must be 16, 24 or 32 bytes long.")
+    return np.frombuffer(os.urandom(n * key_len), dtype=np.uint8).reshape(n, key_len)
+
+# Function to write the keys of blocks first_block, first_block+1, ... as a
+# keystore (keystore.py format: header, record ids, keys) with one write
+def write_keys(path, keys, first_block=0):
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    return write_keystore(path, block_key_ids(first_block, len(keys)), keys)
+
+# Function to read back the keys written by write_keys, in block order
+def read_keys(path):
+    with KeyStore(path) as store:
+        return store.keys.copy()
+
+# Former per-key generation: one os.urandom, base64 and file open per key
+def generate_keys_per_key(path, n, key_len=16):
+    for j in range(n):
+        secret_key = base64.b64encode(os.urandom(key_len))
+        f = open(path, "a")
+        f.write("   Secret Key: %s - (%d)\n" % (secret_key, len(secret_key)))
+        f.close()
+
+####### BEGIN HERE #######
+
+def main():
+    path = "keylist.bin"
+    for key_len in AES_KEY_LENGTHS:
+        for n in (10**4, 10**6):
+            time1 = current_time_ms()
+            keys = generate_keys_bulk(n, key_len)
+            time2 = current_time_ms()
+            file_size = write_keys(path, keys)
+            time3 = current_time_ms()
+            assert (read_keys(path) == keys).all()
+            print("%d keys of %d bytes: generation %.1f ms (%.2f M keys/s), write %.1f ms, %d bytes" %
+                  (n, key_len, time2 - time1, n / max(time2 - time1, 1e-3) / 1000,
+                   time3 - time2, file_size))
+    os.remove(path)
+
+    n = 10**4
+    time1 = current_time_ms()
+    generate_keys_per_key("keylist_bench.txt", n)
+    time2 = current_time_ms()
+    print("%d keys one by one (open/write/close per key): %.1f ms (%.2f M keys/s)" %
+          (n, time2 - time1, n / (time2 - time1) / 1000))
+    os.remove("keylist_bench.txt")
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,12 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
 # Function to generate key
-def generate_key():
+def generate_key(block_id=None, key_deriver=None):
+    # with a key_derivation.KeyDeriver every rank derives the same key of the block locally
+    if key_deriver is not None:
+        if block_id is None:
+            raise ValueError("a block id (sequence number or file offset) is needed to derive the key")
+        return base64.b64encode(key_deriver.block_key(block_id))
    # AES key length must be either 16, 24, or 32 bytes long
     AES_key_length = 16 # use larger value in production
     # generate a random secret key with the decided key length
@@ -32,11 +37,24 @@ def generate_key():
     #     return None
 
 # Function to divide key into geometric segments (rectangle)
-def divide_key_into_segments(key):
+def divide_key_into_segments(key, shamir=None):
+    # With a shamir.Shamir the segments are t-of-n shares of the whole key, one per process
+    if shamir is not None:
+        return shamir.split_key(key)
     # Splitting the key into segments (rectangle) - dividing it into 4 segments
     segmented_keys = [key[i:i+len(key)//4] for i in range(0, len(key), len(key)//4)]
     return segmented_keys
 
+# Function to split the key into Shamir shares on the root only and scatter them:
+# share i goes to rank i % size, no other rank ever holds the key or the other shares
+def scatter_key_shares(key, shamir, root=0):
+    size = comm.Get_size()
+    per_rank = None
+    if rank == root:
+        shares = divide_key_into_segments(key, shamir)
+        per_rank = [[(i, share) for i, share in enumerate(shares) if i % size == r] for r in range(size)]
+    return comm.scatter(per_rank, root=root)
+
 # Function to create key fragment identifiers
 def create_fragment_identifiers(block, key_segments):
     # Creating fragment identifiers for association with block and key segments
@@ -44,27 +62,58 @@ def create_fragment_identifiers(block, key_segments):
     return fragment_identifiers
 
 # Function to distribute key fragments among blockchain sub-cluster using MPI
-def distribute_key_fragments(fragment_ids, key_segments):
+def distribute_key_fragments(fragment_ids, key_segments, data_plane=None):
+    if data_plane is not None:
+        # Segment i goes to rank i % size, all segments with one scatter_block from the root
+        if data_plane.is_root():
+            received = data_plane.scatter_block(key_segments, list(range(len(key_segments))),
+                                                [[i] for i in range(len(key_segments))])
+        else:
+            received = data_plane.scatter_block()
+        for index, _, key_segment in received:
+            print(f"Process {rank} - Received fragment {fragment_ids[index]} with key segment: {bytes(key_segment)}")
+        return received
     # Distributing key fragments among blockchain sub-clusters using MPI
     for fragment_id, key_segment in zip(fragment_ids, key_segments):
         print(f"Process {rank} - Distributing fragment {fragment_id} with key segment: {key_segment}")
 
 # Function representing the ZTP-Key-Dist algorithm using MPI
-def ztp_key_distribution(blockchain_nodes, data_chunk, geometric_shape, chunk_size, redundancy):
-    # Generate the key
-    key = generate_key()
+def ztp_key_distribution(blockchain_nodes, data_chunk, geometric_shape, chunk_size, redundancy, key_deriver=None,
+                         data_plane=None, shamir=None, block_id=None):
+    if shamir is not None:
+        # Only the root holds the key: it draws the shares and every rank receives its own
+        key = None
+        if rank == 0:
+            key = generate_key(block_id, key_deriver) if key_deriver is not None else generate_key()
+        fragment_identifiers = create_fragment_identifiers(data_chunk, range(shamir.n))
+        if data_plane is not None:
+            shares = divide_key_into_segments(key, shamir) if rank == 0 else None
+            received = distribute_key_fragments(fragment_identifiers, shares, data_plane)
+            own_shares = [(index, bytes(share)) for index, _, share in received]
+        else:
+            own_shares = scatter_key_shares(key, shamir)
+            distribute_key_fragments([fragment_identifiers[i] for i, _ in own_shares],
+                                     [share for _, share in own_shares])
+        return own_shares, fragment_identifiers, own_shares
+
+    if key_deriver is not None:
+        # Derive the key on every process from the block id (not the chunk content), no broadcast needed
+        key = generate_key(block_id, key_deriver)
+    else:
+        # Generate the key
+        key = generate_key()
 
-    # Broadcast the key to all processes in the communicator
-    key = comm.bcast(key, root=0)
+        # Broadcast the key to all processes in the communicator
+        key = comm.bcast(key, root=0)
 
     # Divide the key into geometric segments (rectangle)
-    segmented_keys = divide_key_into_segments(key)
+    segmented_keys = divide_key_into_segments(key, shamir)
 
     # Create key fragment identifiers
     fragment_identifiers = create_fragment_identifiers(data_chunk, segmented_keys)
 
     # Distribute key fragments among blockchain sub-cluster using MPI
-    distribute_key_fragments(fragment_identifiers, segmented_keys)
+    distribute_key_fragments(fragment_identifiers, segmented_keys, data_plane)
 
     # Return the segmented data chunks, fragment identifiers, segmented keys
     return segmented_keys, fragment_identifiers, segmented_keys
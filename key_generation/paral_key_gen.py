@@ -14,10 +14,22 @@ def generate_key():
     return encoded_secret_key
 
 # Function to divide key into segments
-def divide_key_into_segments(key):
+def divide_key_into_segments(key, shamir=None):
+    # With a shamir.Shamir the segments are t-of-n shares of the whole key, one per process
+    if shamir is not None:
+        return shamir.split_key(key)
     key_segments = [key[i:i+len(key)//size] for i in range(0, len(key), len(key)//size)]
     return key_segments
 
+# Function to split the key into Shamir shares on the root only and scatter them:
+# share i goes to rank i % size, no other rank ever holds the key or the other shares
+def scatter_key_shares(key, shamir, root=0):
+    per_rank = None
+    if rank == root:
+        shares = divide_key_into_segments(key, shamir)
+        per_rank = [[(i, share) for i, share in enumerate(shares) if i % size == r] for r in range(size)]
+    return comm.scatter(per_rank, root=root)
+
 # Function to create fragment identifiers
 def create_fragment_identifiers(block, key_segments):
     fragment_identifiers = [f"Fragment_{i+1}_of_Block_{block}" for i in range(len(key_segments))]
@@ -29,10 +41,16 @@ def distribute_key_fragments(fragment_ids, key_segments):
         print(f"Process {rank} - Distributing fragment {fragment_id} with key segment: {key_segment}")
 
 # Function representing the ZTP-Key-Dist algorithm using MPI
-def ztp_key_distribution(blockchain_nodes, data_chunk, geometric_shape, chunk_size, redundancy):
+def ztp_key_distribution(blockchain_nodes, data_chunk, geometric_shape, chunk_size, redundancy, shamir=None):
+    if shamir is not None:
+        # Only the root draws the key and its shares, every rank receives its own shares
+        own_shares = scatter_key_shares(generate_key() if rank == 0 else None, shamir)
+        fragment_identifiers = create_fragment_identifiers(data_chunk, range(shamir.n))
+        distribute_key_fragments([fragment_identifiers[i] for i, _ in own_shares], [share for _, share in own_shares])
+        return own_shares, fragment_identifiers, own_shares
     key = generate_key()
     key = comm.bcast(key, root=0)
-    segmented_keys = divide_key_into_segments(key)
+    segmented_keys = divide_key_into_segments(key, shamir)
     fragment_identifiers = create_fragment_identifiers(data_chunk, segmented_keys)
     distribute_key_fragments(fragment_identifiers, segmented_keys)
     return segmented_keys, fragment_identifiers, segmented_keys
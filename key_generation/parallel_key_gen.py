@@ -1,21 +1,14 @@
-from Crypto.Cipher import AES
-import base64, os
+import os, sys
 from mpi4py import MPI
+import numpy as np
 import time
+from bulk_key_gen import generate_keys_bulk
+from parallel_keystore import write_keystore, read_keystore
+from keystore import block_key_ids
 
 def current_time_ms():
     return time.time() * 1000
 
-def generate_secret_key_for_AES_cipher():
-    # AES key length must be either 16, 24, or 32 bytes long
-    AES_key_length = 16 # use larger value in production
-    # generate a random secret key with the decided key length
-    # this secret key will be used to create AES cipher for encryption/decryption
-    secret_key = os.urandom(AES_key_length)
-    # encode this secret key for storing safely in database
-    encoded_secret_key = base64.b64encode(secret_key)
-    return encoded_secret_key
-
 ####### BEGIN HERE #######
 
 def main():
@@ -23,34 +16,41 @@ def main():
     rank = comm.rank
     size = comm.size
 
-    private_msg = """
-    Lorem ipsum dolor sit amet, malis recteque posidonium ea sit, te vis meliore verterem. Duis movet comprehensam eam ex, te mea possim luptatum gloriatur. Modus summo epicuri eu nec. Ex placerat complectitur eos.
-    """
-    padding_character = "{"
-    time1 = 0
-    time2 = 0
-    n = 20  # data chunks
-
-    time1 = current_time_ms()
-    for j in range(rank, n*size, size):
-        f = open("keylist.txt", "a")
-        secret_key = generate_secret_key_for_AES_cipher()
-        f.write("   Secret Key: %s - (%d)\n" % (secret_key, len(secret_key)))
-        f.close()
-    time2 = current_time_ms()
-
-    totaltime = time2 - time1
-    file_size = os.path.getsize('keylist.txt')
-    
-    comm.barrier()  # Ensure all processes have completed writing before calculating the total size
-    total_file_size = comm.allreduce(file_size, op=MPI.SUM)
-
-    if rank == 0:
-        print("Data chunks ", n*size, "keys are of: ", total_file_size, "bytes")
-        print("Time for", n*size, "keys registration: ", totaltime)
-
-    with open("keylist.txt", 'r+') as f:
-        f.truncate(0)
+    # --benchmark: time growing numbers of keys, read them back and remove
+    # the keystore at the end. Otherwise the keystore is kept
+    benchmark = "--benchmark" in sys.argv[1:]
+    path = "keylist.bin"
+    n = 20  # data chunks (keys) per rank
+
+    for n in ((20, 2000, 200000) if benchmark else (n,)):
+        comm.barrier()
+        time1 = current_time_ms()
+        keys = generate_keys_bulk(n)
+        first, _ = write_keystore(path, keys, comm)
+        time2 = current_time_ms()
+        totaltime = comm.reduce(time2 - time1, op=MPI.MAX, root=0)
+        if benchmark:
+            comm.barrier()
+            time1 = current_time_ms()
+            ids, read_back = read_keystore(path, comm)
+            time2 = current_time_ms()
+            readtime = comm.reduce(time2 - time1, op=MPI.MAX, root=0)
+            # every rank wrote n keys, so the share it reads back is its own
+            # records: same ids and same keys
+            assert np.array_equal(ids, block_key_ids(first, n)) and np.array_equal(read_back, keys), \
+                "rank %d read back other keys" % rank
+
+        if rank == 0:
+            file_size = os.path.getsize(path)
+            print("Data chunks ", n*size, "keys are of: ", file_size, "bytes")
+            print("Time for", n*size, "keys registration: ", totaltime)
+            if benchmark:
+                print("Time for", n*size, "keys collective read: ", readtime)
+
+    if benchmark:
+        comm.barrier()
+        if rank == 0:
+            os.remove(path)
 
 if __name__ == '__main__':
     main()
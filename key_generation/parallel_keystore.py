@@ -0,0 +1,47 @@
+from mpi4py import MPI
+import numpy as np
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from keystore import HEADER, block_key_ids, pack_header, unpack_header
+
+# Function to write the keys of every rank into one keystore file (the
+# keystore.py format: header, sorted record ids, keys) with MPI-IO
+def write_keystore(path, keys, comm=MPI.COMM_WORLD, first_block=0):
+    # keys is the (n_local, key_len) uint8 array of this rank: the records
+    # of rank r start right after the ones of ranks 0..r-1, so the offset
+    # comes from an exclusive prefix sum of the local counts. Rank r holds
+    # the keys of blocks first_block+first..., so the ids stay sorted
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    n_local, key_len = keys.shape
+    first = comm.exscan(n_local)
+    if first is None:  # rank 0
+        first = 0
+    total = comm.allreduce(n_local, op=MPI.SUM)
+    ids = block_key_ids(first_block + first, n_local)
+    header = np.frombuffer(pack_header(key_len, total) if comm.Get_rank() == 0 else b'', dtype=np.uint8)
+    fh = MPI.File.Open(comm, path, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+    fh.Set_size(0)  # collective: drop the records of a previous run
+    fh.Write_at_all(0, header)
+    fh.Write_at_all(HEADER.size + first * ids.itemsize, ids)
+    fh.Write_at_all(HEADER.size + total * ids.itemsize + first * key_len, keys)
+    fh.Close()
+    return first, total
+
+# Function to read back a keystore, every rank gets a contiguous share of
+# the record ids and of their keys
+def read_keystore(path, comm=MPI.COMM_WORLD):
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    fh = MPI.File.Open(comm, path, MPI.MODE_RDONLY)
+    header = np.empty(HEADER.size, dtype=np.uint8)
+    fh.Read_at_all(0, header)
+    key_len, total = unpack_header(header, path)
+    n_local = total // size + (1 if rank < total % size else 0)
+    first = rank * (total // size) + min(rank, total % size)
+    ids = np.empty(n_local, dtype=np.uint64)
+    keys = np.empty((n_local, key_len), dtype=np.uint8)
+    fh.Read_at_all(HEADER.size + first * ids.itemsize, ids)
+    fh.Read_at_all(HEADER.size + total * ids.itemsize + first * key_len, keys)
+    fh.Close()
+    return ids, keys
@@ -0,0 +1,185 @@
+#Pool of pre-generated AES keys kept filled by a background thread
+__all__=['KeyPool']
+
+import os
+import threading
+import time
+from collections import deque
+
+
+class KeyPool:
+    """
+    Keys are generated in batches of batch keys by a background thread
+    whenever the pool falls below low, up to high keys, so that take()
+    normally returns without generating anything. A take() finding the pool
+    short waits for the refill (or generates inline when the thread is not
+    running); these waits are counted in stats()
+    """
+
+    def __init__(self, key_len=16, low=1024, high=4096, batch=256, generator=None):
+        if key_len not in (16, 24, 32):
+            raise ValueError("AES key must be 16, 24 or 32 bytes long.")
+        if not 0 <= low < high:
+            raise ValueError("low watermark must be below high watermark")
+        self.key_len   = key_len
+        self.low       = low
+        self.high      = high
+        self.batch     = batch
+        self.generator = generator if generator is not None else self.__generate
+        self.keys      = deque()
+        self.cond      = threading.Condition()
+        self.thread    = None
+        self.closing   = False
+        self.requested = 0   # keys asked for by waiting takes
+        # statistics
+        self.takes     = 0
+        self.hits      = 0   # takes served without waiting
+        self.waits     = 0
+        self.wait_time = 0.0
+        self.generated = 0
+        self.refills   = 0
+
+    def __generate(self, n):
+        """
+        n keys from one os.urandom call
+        """
+        raw = os.urandom(n * self.key_len)
+        return [raw[i:i + self.key_len] for i in range(0, len(raw), self.key_len)]
+
+    def start(self):
+        """
+        Fill the pool up to high and start the refill thread
+        """
+        if self.thread is None:
+            self.__fill(self.high)
+            self.closing = False
+            self.thread = threading.Thread(target=self.__refill, name='key-pool', daemon=True)
+            self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            with self.cond:
+                self.closing = True
+                self.cond.notify_all()
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __fill(self, n):
+        while n > 0:
+            keys = self.generator(min(self.batch, n))
+            with self.cond:
+                self.keys.extend(keys)
+                self.generated += len(keys)
+                self.cond.notify_all()
+            n -= len(keys)
+
+    def __refill(self):
+        while True:
+            with self.cond:
+                while not self.closing and len(self.keys) >= max(self.low, self.requested):
+                    self.cond.wait()
+                if self.closing:
+                    return
+                missing = max(self.high, self.requested) - len(self.keys)
+                self.refills += 1
+            # keys are generated outside of the lock, takes keep being served
+            self.__fill(missing)
+
+    def __wake_refill(self):
+        # called with the lock held, after keys were taken: other takes may
+        # still be waiting for keys
+        if len(self.keys) < max(self.low, self.requested):
+            self.cond.notify_all()
+
+    def take(self, n=1):
+        """
+        Return a list of n keys
+        """
+        with self.cond:
+            self.takes += 1
+            if len(self.keys) >= n:
+                self.hits += 1
+                keys = [self.keys.popleft() for _ in range(n)]
+                self.__wake_refill()
+                return keys
+            self.waits += 1
+            start = time.perf_counter()
+            if self.thread is not None:
+                self.requested += n
+                self.cond.notify_all()
+                while len(self.keys) < n and not self.closing:
+                    self.cond.wait()
+                self.requested -= n
+            if len(self.keys) < n:
+                # no refill thread: generate inline
+                keys = self.generator(n - len(self.keys))
+                self.keys.extend(keys)
+                self.generated += len(keys)
+            keys = [self.keys.popleft() for _ in range(n)]
+            self.wait_time += time.perf_counter() - start
+            self.__wake_refill()
+            return keys
+
+    def get(self):
+        """
+        Return a single key
+        """
+        return self.take(1)[0]
+
+    def stats(self):
+        return {'size': len(self.keys),
+                'low': self.low,
+                'high': self.high,
+                'takes': self.takes,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.takes if self.takes else None,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'generated': self.generated,
+                'refills': self.refills}
+
+
+def benchmark(blocks=2000, chunks=16, key_len=32, work=0.0005):
+    """
+    Sustained ingestion of blocks of chunks: time spent getting the block
+    and chunk keys with inline generation (random.getrandbits per byte, as
+    in exe.py, and os.urandom per key) and with the key pool. work seconds
+    of distribution per block let the refill thread run
+    """
+    import random
+    inline = {
+        'getrandbits per key': lambda: bytes(random.getrandbits(8) for _ in range(key_len)),
+        'os.urandom per key':  lambda: os.urandom(key_len),
+    }
+    for name, generate in inline.items():
+        spent = 0.0
+        for _ in range(blocks):
+            t0 = time.perf_counter()
+            generate()
+            for _ in range(chunks):
+                generate()
+            spent += time.perf_counter() - t0
+            time.sleep(work)
+        print("%-22s key time %8.1f ms (%.1f us per block)" % (name, spent * 1000, spent / blocks * 1e6))
+
+    with KeyPool(key_len, low=8 * (chunks + 1), high=64 * (chunks + 1)) as pool:
+        spent = 0.0
+        for _ in range(blocks):
+            t0 = time.perf_counter()
+            pool.get()
+            pool.take(chunks)
+            spent += time.perf_counter() - t0
+            time.sleep(work)
+        print("%-22s key time %8.1f ms (%.1f us per block)" % ('key pool', spent * 1000, spent / blocks * 1e6))
+        print(pool.stats())
+
+
+if __name__ == '__main__':
+    benchmark()
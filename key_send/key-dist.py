@@ -31,35 +31,77 @@ def abe_encrypt(data, policy):
     """
     Simplified ABE encryption: hash the data with policy to simulate encryption.
     This is a placeholder for a real ABE encryption scheme.
+    The key fragments are bytes, a str is encoded first.
     """
-    return hashlib.sha256((policy + data).encode()).hexdigest()
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(policy.encode() + data).hexdigest()
 
 
 class BlockchainNode:
     def __init__(self, node_id):
         self.node_id = node_id
         self.metadata = {}  # Metadata storage for fragments/chunks
+        self.shards = {}  # (block id, chunk index, shard index) -> erasure shard held by this node
 
     def receive_data(self, data):
         # Simulate receiving data (chunks or key fragments)
         print(f"Node {self.node_id} received data: {data}")
 
+    def receive_shard(self, block_id, index, shard_index, shard):
+        # Keep the shard, the accumulator fetches it back with collect_shards
+        self.shards[(block_id, index, shard_index)] = shard
+        self.receive_data(shard)
+
 
 class Blockchain:
-    def __init__(self, num_nodes, data_block, geometric_shape, chunk_size, redundancy, access_policy):
+    def __init__(self, num_nodes, data_block, geometric_shape, chunk_size, redundancy, access_policy,
+                 block_id=None, key_deriver=None, key_pool=None, data_plane=None,
+                 placement=None, erasure=None, shamir=None, catalog=None, cipher=None):
         self.nodes = [BlockchainNode(i) for i in range(num_nodes)]
         self.data_block = data_block
+        self.block_id = block_id  # Sequence number or file offset of the block, never its content
+        self.key_deriver = key_deriver  # Optional key_derivation.KeyDeriver
+        self.key_pool = key_pool  # Optional key_pool.KeyPool of pre-generated keys
+        # Optional parallel_chunks.ParallelChunkCipher, long-lived across blocks: the chunks are
+        # encrypted and hashed on its threads with the block key (its chunk size must be chunk_size)
+        if cipher is not None and cipher.chunk_size != chunk_size:
+            raise ValueError(f"the cipher chunk size {cipher.chunk_size} is not the chunk size {chunk_size}")
+        self.cipher = cipher
+        self.sealed = None  # EncryptedBlock of the current block with a cipher (nonce and tags)
+        self.chunk_digests = []  # SHA-256 of every encrypted chunk, in chunk order
+        self.data_plane = data_plane  # Optional data_plane.DataPlane, node i is hosted by MPI rank i % size
+        self.outgoing = []  # (item, nodes) waiting to be sent by the data plane
+        self.placement = placement  # Optional placement.Placement over the node ids
+        self.leader_placement = None  # Placement over the leaders of the current block
+        self.key_nodes = set()  # Node ids holding a key fragment of the current block
+        self.erasure = erasure  # Optional erasure.ReedSolomon: n shards per chunk instead of r copies
+        self.shard_map = {}  # chunk index -> (encrypted chunk length, node id of every shard)
+        self.shamir = shamir  # Optional shamir.Shamir: n key shares, one per node, instead of r copies
+        self.catalog = catalog  # Optional catalog.MetadataCatalog of the holders, replicated on the leaders
         self.geometric_shape = geometric_shape
         self.chunk_size = chunk_size
         self.redundancy = redundancy
         self.access_policy = access_policy
 
+    def __require_block_id(self, purpose):
+        if self.block_id is None:
+            raise ValueError(f"a block_id (sequence number or file offset) is needed for {purpose}")
+        return self.block_id
+
     def select_leaders(self, data_block):
         """
         Select dynamic leader nodes for distributing data and keys.
         This uses a simple random selection of leaders from the network.
+        With a placement, the leaders are the rendezvous of the block id, the same on every rank.
         """
         num_leaders = int(len(self.nodes) * 0.2)  # 20% of nodes are leaders for simplicity
+        if self.placement is not None:
+            block_id = self.__require_block_id("the placement")
+            leaders = [self.nodes[i] for i in self.placement.holders(('leaders', block_id), num_leaders)]
+            self.leader_placement = self.placement.subset([leader.node_id for leader in leaders])
+            self.key_nodes = set()
+            return leaders
         leaders = random.sample(self.nodes, num_leaders)
         return leaders
 
@@ -67,14 +109,22 @@ class Blockchain:
         """
         Generate a unique AES key for the data block.
         For simplicity, we use random bytes as the key.
+        With a key deriver, the key is derived from the block id instead.
         """
+        if self.key_deriver is not None:
+            return self.key_deriver.block_key(self.__require_block_id("the key derivation"))
+        if self.key_pool is not None:
+            return self.key_pool.get()
         return get_random_bytes(16)  # AES requires 16, 24, or 32 bytes key
 
     def fragment_key(self, aes_key, shape):
         """
         Split AES key into segments based on geometric shape.
         For simplicity, we split the key into equal-sized segments.
+        With Shamir sharing, the fragments are the n shares of the whole key, any t rebuild it.
         """
+        if self.shamir is not None:
+            return self.shamir.split_key(aes_key)
         num_fragments = len(aes_key) // 16  # Assuming each fragment is 16 bytes (128 bits)
         return [aes_key[i:i + 16] for i in range(0, len(aes_key), 16)]
 
@@ -89,20 +139,45 @@ class Blockchain:
         """
         Generate unique identifiers for each key fragment.
         For simplicity, we use hashes of the fragments as identifiers.
+        The fragments are bytes (a str fragment is encoded first).
         """
-        return [hashlib.sha256(frag.encode()).hexdigest() for frag in key_fragments]
+        return [hashlib.sha256(frag.encode() if isinstance(frag, str) else frag).hexdigest()
+                for frag in key_fragments]
 
-    def select_nodes_for_key(self, key_fragment, redundancy, leaders):
+    def select_nodes_for_key(self, key_fragment, redundancy, leaders, index=None):
         """
         Select nodes for distributing the ABE-encrypted key fragment.
         Ensure redundancy by selecting 'r' leaders from the list of dynamic leaders.
+        With a placement, the holders are computed from the block id and the fragment index.
         """
+        if self.leader_placement is not None:
+            ids = self.leader_placement.holders(('fragment', self.block_id, index), redundancy)
+            self.key_nodes.update(ids)
+            return [self.nodes[i] for i in ids]
         return random.sample(leaders, redundancy)
 
+    def select_nodes_for_shares(self, n, leaders):
+        """
+        Select one distinct leader per Shamir share, all n at once: two shares on the
+        same node would let it rebuild the key alone with t=2.
+        With a placement, the holders are computed from the block id.
+        """
+        if len(leaders) < n:
+            raise ValueError(f"{n} Shamir shares need {n} distinct leaders, {len(leaders)} available")
+        if self.leader_placement is not None:
+            ids = self.leader_placement.holders(('shares', self.block_id), n)
+            self.key_nodes.update(ids)
+            return [[self.nodes[i]] for i in ids]
+        return [[leader] for leader in random.sample(leaders, n)]
+
     def distribute_fragment(self, key_fragment, nodes):
         """
         Simulate distributing the ABE-encrypted key fragment to the selected nodes.
+        With a data plane, the fragment is sent with the rest of the block by flush_distribution.
         """
+        if self.data_plane is not None:
+            self.outgoing.append((key_fragment.encode() if isinstance(key_fragment, str) else key_fragment, nodes))
+            return
         for node in nodes:
             node.receive_data(key_fragment)
 
@@ -112,12 +187,17 @@ class Blockchain:
         """
         return [data_block[i:i + chunk_size] for i in range(0, len(data_block), chunk_size)]
 
-    def generate_chunk_key(self, chunk):
+    def generate_chunk_key(self, chunk, index=None):
         """
         Generate a unique AES key for each data chunk.
         For simplicity, use a hash of the chunk as the key.
+        With a key deriver, the key is derived from the block id and the chunk index.
         """
-        return hashlib.sha256(chunk.encode()).hexdigest()
+        if self.key_deriver is not None:
+            if index is None:
+                raise ValueError("a chunk index is needed for the key derivation")
+            return self.key_deriver.chunk_key(self.__require_block_id("the key derivation"), index)
+        return hashlib.sha256(chunk.encode()).digest()  # 32 bytes, an AES-256 key
 
     def encrypt_chunk(self, chunk, chunk_key):
         """
@@ -125,24 +205,91 @@ class Blockchain:
         """
         return aes_encrypt(chunk, chunk_key)
 
-    def select_nodes_for_data(self, chunk, redundancy, leaders):
+    def seal_chunk(self, chunk, chunk_key):
+        """
+        Encrypt a data chunk and hash the encrypted chunk, so a holder can check what it stores.
+        """
+        encrypted_chunk = self.encrypt_chunk(chunk, chunk_key)
+        return encrypted_chunk, hashlib.sha256(encrypted_chunk).digest()
+
+    def select_nodes_for_data(self, chunk, redundancy, leaders, index=None):
         """
         Select nodes for distributing the data chunk.
         Ensure redundancy by selecting 'r' nodes from the leaders, without overlap with key nodes.
+        With a placement, the holders are computed from the block id and the chunk index,
+        excluding the nodes holding a key fragment of the block (taken from all the nodes
+        when too few leaders are left).
         """
+        if self.leader_placement is not None:
+            ids = self.leader_placement.data_holders(('chunk', self.block_id, index), redundancy,
+                                                     self.key_nodes, self.placement)
+            return [self.nodes[i] for i in ids]
         return random.sample(leaders, redundancy)
 
     def distribute_chunk(self, chunk, nodes):
         """
         Distribute the encrypted chunk to the selected nodes.
+        With a data plane, the chunk is sent with the rest of the block by flush_distribution.
         """
+        if self.data_plane is not None:
+            self.outgoing.append((chunk, nodes))
+            return
         for node in nodes:
             node.receive_data(chunk)
 
-    def record_metadata(self, leaders, data):
+    def store_chunk(self, chunk, encrypted_chunk, index, leaders):
+        """
+        Send an encrypted chunk to its holders: 'redundancy' full copies, or with an
+        erasure code, one of its n shards to each of n distinct nodes (any k rebuild it).
+        Return the holders.
+        """
+        if self.erasure is None:
+            selected_nodes_for_data = self.select_nodes_for_data(chunk, self.redundancy, leaders, index)
+            self.distribute_chunk(encrypted_chunk, selected_nodes_for_data)
+            return selected_nodes_for_data
+        shards = self.erasure.encode(encrypted_chunk)
+        selected_nodes_for_data = self.select_nodes_for_data(chunk, self.erasure.n, leaders, index)
+        self.shard_map[index] = (len(encrypted_chunk), [node.node_id for node in selected_nodes_for_data])
+        for shard_index, (shard, node) in enumerate(zip(shards, selected_nodes_for_data)):
+            if self.data_plane is not None:
+                self.distribute_chunk(shard.tobytes(), [node])
+            else:
+                node.receive_shard(self.block_id, index, shard_index, shard.tobytes())
+        return selected_nodes_for_data
+
+    def flush_distribution(self):
+        """
+        Send all the fragments and chunks of the block queued by distribute_fragment and
+        distribute_chunk with one scatter_block, then hand them to the local nodes.
+        Must be called by all the ranks: the non-root ranks pass nothing and only receive.
+        """
+        if self.data_plane.is_root():
+            items = [item for item, _ in self.outgoing]
+            placement = [[node.node_id for node in nodes] for _, nodes in self.outgoing]
+            received = self.data_plane.scatter_block(items, list(range(len(items))), placement)
+            self.outgoing = []
+        else:
+            received = self.data_plane.scatter_block()
+        for _, node_id, data in received:
+            self.nodes[node_id].receive_data(bytes(data))
+        return received
+
+    def record_metadata(self, leaders, data, kind=None, holders=None):
         """
         Record metadata about the distribution of fragments/chunks to leader nodes.
+        With a catalog, the holders of the fragments/chunks (not their content) are inserted
+        under the block id, and every leader applies the delta of the inserts it misses to its
+        own replica (a leader without one gets the whole catalog).
         """
+        if self.catalog is not None:
+            kind = self.catalog.KIND_FRAGMENT if kind == 'fragment' else self.catalog.KIND_CHUNK
+            self.catalog.insert(self.__require_block_id("the catalog"), kind, [[node.node_id for node in nodes] for nodes in holders])
+            for leader in leaders:
+                replica = leader.metadata.get("catalog")
+                if replica is None:
+                    replica = leader.metadata["catalog"] = self.catalog.replica()
+                replica.apply(self.catalog.leader_delta(leader.node_id, reset=replica.version == 0))
+            return
         for leader in leaders:
             leader.metadata["distribution"] = data  # Simplified metadata recording
 
@@ -150,6 +297,11 @@ class Blockchain:
         """
         Main function for Parallel Data and Key Distribution
         """
+        if self.data_plane is not None and not self.data_plane.is_root():
+            # The root rank runs the distribution, the other ranks receive their part
+            self.flush_distribution()
+            return None
+
         # Step 1: Select dynamic leader nodes
         leaders = self.select_leaders(self.data_block)
 
@@ -163,26 +315,51 @@ class Blockchain:
         # Step 4: Generate unique identifiers for each key fragment
         identifiers = self.generate_identifiers(key_fragments)
 
-        # Step 5: Distribute the encrypted key fragments
-        for i, key_fragment in enumerate(abe_encrypted_keys):
-            selected_nodes_for_key = self.select_nodes_for_key(key_fragment, self.redundancy, leaders)
+        # Step 5: Distribute the encrypted key fragments (the Shamir shares go to n distinct nodes)
+        if self.shamir is not None:
+            fragment_holders = self.select_nodes_for_shares(len(abe_encrypted_keys), leaders)
+        else:
+            fragment_holders = [self.select_nodes_for_key(key_fragment, self.redundancy, leaders, i)
+                                for i, key_fragment in enumerate(abe_encrypted_keys)]
+        for key_fragment, selected_nodes_for_key in zip(abe_encrypted_keys, fragment_holders):
             self.distribute_fragment(key_fragment, selected_nodes_for_key)
 
         # Step 6: Record metadata for key distribution
-        self.record_metadata(leaders, identifiers)
+        self.record_metadata(leaders, identifiers, 'fragment', fragment_holders)
 
         # Step 7: Split the data block into chunks
         data_chunks = self.split_block(self.data_block, self.chunk_size)
 
         # Step 8: Encrypt each chunk and distribute to selected nodes
-        for chunk in data_chunks:
-            chunk_key = self.generate_chunk_key(chunk)
-            encrypted_chunk = self.encrypt_chunk(chunk, chunk_key)
-            selected_nodes_for_data = self.select_nodes_for_data(chunk, self.redundancy, leaders)
-            self.distribute_chunk(encrypted_chunk, selected_nodes_for_data)
+        # (the chunk keys of the block are taken from the key pool in one batch)
+        chunk_holders = []
+        if self.cipher is not None:
+            # Parallel mode: the whole block in one call, chunk i under the block key and nonce + i
+            self.sealed, digests = self.cipher.encrypt(self.data_block.encode(), key=aes_key)
+            sealed = list(zip(self.sealed.chunks(), digests))
+        else:
+            chunk_keys = None
+            if self.key_pool is not None and self.key_deriver is None:
+                chunk_keys = self.key_pool.take(len(data_chunks))
+            if chunk_keys is None:
+                chunk_keys = [self.generate_chunk_key(chunk, index) for index, chunk in enumerate(data_chunks)]
+            sealed = [self.seal_chunk(chunk, chunk_key) for chunk, chunk_key in zip(data_chunks, chunk_keys)]
+        self.chunk_digests = [digest for _, digest in sealed]
+        for index, (chunk, (encrypted_chunk, _)) in enumerate(zip(data_chunks, sealed)):
+            chunk_holders.append(self.store_chunk(chunk, encrypted_chunk, index, leaders))
 
         # Step 9: Record metadata for chunk distribution
-        self.record_metadata(leaders, data_chunks)
+        self.record_metadata(leaders, data_chunks, 'chunk', chunk_holders)
+        for leader in leaders:
+            leader.metadata["digests"] = self.chunk_digests
+            if self.sealed is not None:
+                leader.metadata["nonce"], leader.metadata["tags"] = self.sealed.nonce, self.sealed.tags
+            if self.erasure is not None:
+                leader.metadata["shards"] = dict(self.shard_map)
+
+        # Step 10: With a data plane, deliver everything queued for the block at once
+        if self.data_plane is not None:
+            self.flush_distribution()
 
         return data_chunks, abe_encrypted_keys, key_fragments
 
@@ -0,0 +1,194 @@
+#Fixed-record binary keystore of the block, chunk and fragment keys
+__all__=['KeyStore', 'key_id', 'block_key_ids', 'write_keystore', 'read_text_keylist',
+         'pack_header', 'unpack_header', 'KIND_BLOCK', 'KIND_CHUNK', 'KIND_FRAGMENT']
+
+import base64
+import mmap
+import re
+import struct
+
+import numpy as np
+
+#
+# File layout: a 16 bytes header (magic, version, key length, number of
+# records), the record ids as sorted uint64, then the keys in id order.
+# It is the only key file format of the tree: write_keystore writes it from
+# one process, key_generation/parallel_keystore.py collectively with MPI-IO
+#
+MAGIC      = b'ZTPK'
+VERSION    = 1
+HEADER     = struct.Struct('<4sHHQ')
+
+KIND_BLOCK    = 0
+KIND_CHUNK    = 1
+KIND_FRAGMENT = 2
+
+
+def key_id(kind, block, index=0):
+    """
+    Record id of the key of a block (index is unused), of its chunk number
+    index or of its key fragment number index
+    """
+    if not 0 <= block < 1 << 32 or not 0 <= index < 1 << 24:
+        raise ValueError("block id or chunk/fragment index out of range")
+    return (kind << 56) | (block << 24) | index
+
+
+def block_key_ids(first_block, n):
+    """
+    Record ids (sorted uint64 array) of the keys of the n consecutive
+    blocks first_block, first_block+1, ...
+    """
+    if first_block < 0 or first_block + n > 1 << 32:
+        raise ValueError("block id out of range")
+    return (np.uint64(KIND_BLOCK << 56) |
+            (np.arange(first_block, first_block + n, dtype=np.uint64) << np.uint64(24)))
+
+
+def pack_header(key_len, count):
+    return HEADER.pack(MAGIC, VERSION, key_len, count)
+
+
+def unpack_header(buf, path='buffer'):
+    """
+    (key length, number of records) of a keystore header
+    """
+    magic, version, key_len, count = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a keystore file" % path)
+    return key_len, count
+
+
+def write_keystore(path, ids, keys):
+    """
+    Write the keys (a (n, key_len) uint8 array or a list of equal length
+    bytes) under the record ids with a single write, return the file size
+    """
+    ids  = np.asarray(ids, dtype=np.uint64)
+    keys = np.asarray([np.frombuffer(k, dtype=np.uint8) for k in keys]
+                      if not isinstance(keys, np.ndarray) else keys, dtype=np.uint8)
+    if keys.ndim != 2 or len(ids) != len(keys):
+        raise ValueError("one key per record id expected")
+    order = np.argsort(ids, kind='stable')
+    ids, keys = ids[order], keys[order]
+    if len(ids) > 1 and (ids[1:] == ids[:-1]).any():
+        raise ValueError("duplicate record id")
+    header = pack_header(keys.shape[1], len(ids))
+    with open(path, 'wb') as f:
+        f.write(b''.join((header, ids.tobytes(), np.ascontiguousarray(keys).tobytes())))
+    return HEADER.size + ids.nbytes + keys.nbytes
+
+
+def read_text_keylist(path):
+    """
+    Decode the keys of a legacy keylist.txt ("   Secret Key: ... - (24)"
+    records without delimiter) into a list of raw keys
+    """
+    with open(path) as f:
+        text = f.read()
+    return [base64.b64decode(k) for k in
+            re.findall(r"Secret Key: (?:b')?([A-Za-z0-9+/]+=*)'? - \(\d+\)", text)]
+
+
+class KeyStore:
+    """
+    Read-only view of a keystore file. The file is mapped, not loaded: a
+    lookup is a binary search in the mapped id array followed by the read
+    of one key record
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map  = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key_len, self.count = unpack_header(self.map, path)
+        self.ids  = np.frombuffer(self.map, dtype=np.uint64, count=self.count,
+                                  offset=HEADER.size)
+        self.keys = np.frombuffer(self.map, dtype=np.uint8, count=self.count * self.key_len,
+                                  offset=HEADER.size + self.ids.nbytes).reshape(-1, self.key_len)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, rid):
+        if not isinstance(rid, (int, np.integer)) or rid < 0:
+            return False
+        i = int(self.ids.searchsorted(np.uint64(rid)))
+        return i < self.count and self.ids[i] == rid
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __locate(self, rids):
+        rids = np.asarray(rids, dtype=np.uint64)
+        pos  = np.searchsorted(self.ids, rids)
+        bad  = pos >= self.count
+        pos[bad] = 0
+        bad |= self.ids[pos] != rids
+        if bad.any():
+            raise KeyError(int(rids[np.argmax(bad)]))
+        return pos
+
+    def get(self, rid):
+        """
+        Key of the record id rid as bytes
+        """
+        i = int(self.ids.searchsorted(np.uint64(rid)))
+        if i >= self.count or self.ids[i] != rid:
+            raise KeyError(rid)
+        return self.keys[i].tobytes()
+
+    def get_many(self, rids):
+        """
+        Keys of all the record ids of rids as a (len(rids), key_len) array,
+        in the order of rids
+        """
+        return self.keys[self.__locate(rids)]
+
+    def close(self):
+        # the numpy views keep exports of the map alive until dropped
+        self.ids = self.keys = None
+        self.map.close()
+        self.file.close()
+
+
+def benchmark(n=10**6, lookups=10**5, path='keystore_bench.bin'):
+    """
+    Compare resolving keys from the legacy text keylist, parsed as a whole,
+    with single and batched lookups in the mapped keystore
+    """
+    import os
+    import time
+    text_path = path + '.txt'
+    keys = np.frombuffer(os.urandom(n * 16), dtype=np.uint8).reshape(n, 16)
+    ids  = [key_id(KIND_BLOCK, b) for b in range(n)]
+    with open(text_path, 'w') as f:
+        f.write(''.join("   Secret Key: %s - (24)" % base64.b64encode(k.tobytes()).decode()
+                        for k in keys))
+    write_keystore(path, ids, keys)
+    wanted = np.random.randint(0, n, lookups)
+
+    t0 = time.perf_counter()
+    text_keys = read_text_keylist(text_path)
+    text_hit = [text_keys[b] for b in wanted]
+    t1 = time.perf_counter()
+    with KeyStore(path) as store:
+        t2 = time.perf_counter()
+        single = [store.get(ids[b]) for b in wanted]
+        t3 = time.perf_counter()
+        batch = store.get_many(np.asarray(ids, dtype=np.uint64)[wanted])
+        t4 = time.perf_counter()
+        assert single == text_hit and batch.tobytes() == b''.join(single)
+    os.remove(path)
+    os.remove(text_path)
+    print("%d keys, %d lookups" % (n, lookups))
+    print("text keylist (parse all):  %8.1f ms" % ((t1 - t0) * 1000))
+    print("keystore open:             %8.3f ms" % ((t2 - t1) * 1000))
+    print("keystore single lookups:   %8.1f ms (%.2f us each)" % ((t3 - t2) * 1000, (t3 - t2) / lookups * 1e6))
+    print("keystore batched lookup:   %8.1f ms" % ((t4 - t3) * 1000))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,38 +1,183 @@
 #parallel workload management of blockchain nodes workgroups
-from mpi_master_slave import WorkQueue 
+from mpi4py import MPI
+from work_queue import WorkQueue
+from queue_metrics import dump_json
+from records import Node
 
-__all__=['MultiWorkQueue']
+__all__=['MultiWorkQueue', 'gather_hosts']
+
+
+def gather_hosts(comm=None):
+    """
+    Return the host name of every rank of comm (indexed by rank). This is a
+    collective call: every rank, masters and slaves, must call it
+    """
+    comm = comm if comm is not None else MPI.COMM_WORLD
+    return comm.allgather(MPI.Get_processor_name())
 
 class MultiWorkQueue:
     """
-    Handle multiple work queues
+    Handle multiple work queues. masters_details holds (task_id, master,
+    num_slaves) tuples, optionally followed by a dict of WorkQueue options
+    for that task (cache_capacity, fault_factor, max_retries,
+    retry_base_delay, retry_max_delay, memory_budget, spill_path, prefetch).
+    fault_factor defaults to 0: a block runs on one slave, as with
+    mpi_master_slave.WorkQueue, unless a task asks for f+1 replicas.
+
+    With hosts (the host of every slave, see gather_hosts), master_hosts
+    must give the home host of every task_id, e.g. where its data lives:
+    all the masters run in this process, so its own host tells nothing
+    about where a task's slaves should be
     """
        
-    def __init__(self, slaves, masters_details, nodes):
+    def __init__(self, slaves, masters_details, nodes, rebalance_policy=None, weights=None,
+                 hosts=None, master_hosts=None, slo_controller=None):
         self.slaves = list(slaves)
+        self.rebalance_policy = rebalance_policy
+        self.slo_controller   = slo_controller
         self.nodes = nodes.copy()
         self.work_queue = {}
         self.num_slaves = {}
-        for task_id, master, num_slaves in masters_details:
-            self.work_queue[task_id] = WorkQueue(master)  # Separate work queues are created based on cluster ID
+        self.migrations = 0
+        self.borrowed   = {}  # task_id -> slaves received from other masters
+        self.lent       = {}  # task_id -> slaves given to other masters
+        #
+        # topology: host of every slave (dict or list indexed by rank) and
+        # home host of every task_id, slaves on the home host are preferred
+        #
+        self.hosts        = hosts
+        self.master_hosts = dict(master_hosts or {}) if hosts is not None else {}
+        self.placements   = 0
+        self.intra_node   = 0
+        for task_id, master, num_slaves, *options in masters_details:
+            options = {'fault_factor': 0, **(options[0] if options else {})}
+            self.work_queue[task_id] = WorkQueue(master, **options)  # Separate work queues are created based on cluster ID
             self.num_slaves[task_id] = num_slaves
+            self.borrowed[task_id]   = 0
+            self.lent[task_id]       = 0
+        if hosts is not None:
+            missing = [task_id for task_id in self.work_queue if not self.master_hosts.get(task_id)]
+            if missing:
+                raise ValueError("hosts given without the home host of task_id %s in master_hosts" % missing)
 
         # assign slaves to Masters
-        slaves = list(slaves)
-        #nodes = nodes
-        while slaves:
-            for task_id, work_queue in self.work_queue.items():
-                if not slaves:
-                    break
-                num_slaves = self.num_slaves[task_id]
-                master     = work_queue.master
-                if num_slaves is None or master.num_slaves() < num_slaves:
-                    slv = slaves.pop(0)
-                    nd = self.nodes.pop(slv)
+        plan = self.__plan_slaves(self.slaves, weights)
+        if hosts is not None:
+            plan = self.__place_by_host(plan)
+        for task_id, assigned in plan.items():
+            self.__count_placements(task_id, assigned)
+            master = self.work_queue[task_id].master
+            nodes  = []
+            for slv in assigned:
+                nd = self.nodes.pop(slv, None)
+                if nd is None:
+                    nd = Node(slv)
+                nodes.append(nd)
+            add_slaves = getattr(master, 'add_slaves', None)
+            if add_slaves is not None:
+                add_slaves(assigned, nodes, ready=True)
+            else:
+                for slv, nd in zip(assigned, nodes):
                     master.add_slave(slv, nd, ready=True)
-                    #node = self.nodes.pop(0)
                     #print("multi queue",nd.id)     #Track whether NODE is properly assigned to master               
-                    
+
+    def __place_by_host(self, plan):
+        """
+        Keep the number of slaves of every master in plan, but give each
+        master the slaves on its home host first
+        """
+        by_host = {}
+        for assigned in plan.values():
+            for slv in assigned:
+                by_host.setdefault(self.hosts[slv], []).append(slv)
+
+        placed  = {}
+        missing = {}
+        for task_id, assigned in plan.items():
+            local = by_host.get(self.master_hosts[task_id], [])
+            n = min(len(assigned), len(local))
+            placed[task_id] = local[:n]
+            del local[:n]
+            missing[task_id] = len(assigned) - n
+
+        rest = [slv for local in by_host.values() for slv in local]
+        for task_id, n in missing.items():
+            placed[task_id].extend(rest[:n])
+            del rest[:n]
+        return placed
+
+    def __count_placements(self, task_id, slaves):
+        if self.hosts is None:
+            return
+        home = self.master_hosts[task_id]
+        self.placements += len(slaves)
+        self.intra_node += sum(1 for slv in slaves if self.hosts[slv] == home)
+
+    def topology_stats(self):
+        """
+        Return how many slave assignments (initial ones and moves) were to a
+        slave on the home host of its master
+        """
+        return {'placements': self.placements,
+                'intra_node': self.intra_node,
+                'intra_node_fraction': self.intra_node / self.placements if self.placements else None}
+
+    def __plan_slaves(self, slaves, weights=None):
+        """
+        Compute in one pass the slave->master mapping: slaves are dealt to the
+        masters with a smooth weighted round robin (plain round robin when no
+        weights are given), a master stops receiving slaves when it reaches
+        its num_slaves. Slaves exceeding every limit are left unassigned.
+        Return {task_id: [slaves]}
+        """
+        plan     = {task_id: [] for task_id in self.work_queue}
+        capacity = {}
+        for task_id, work_queue in self.work_queue.items():
+            num_slaves = self.num_slaves[task_id]
+            capacity[task_id] = None if num_slaves is None else \
+                num_slaves - work_queue.master.num_slaves()
+        weight  = {task_id: (weights or {}).get(task_id, 1) for task_id in self.work_queue}
+        current = dict.fromkeys(self.work_queue, 0)
+        open_ids = [task_id for task_id in self.work_queue
+                    if weight[task_id] > 0 and (capacity[task_id] is None or capacity[task_id] > 0)]
+        total = sum(weight[task_id] for task_id in open_ids)
+
+        if weights is None:
+            #
+            # plain round robin
+            #
+            i = 0
+            for slv in slaves:
+                if not open_ids:
+                    break
+                task_id = open_ids[i]
+                plan[task_id].append(slv)
+                i += 1
+                if capacity[task_id] is not None:
+                    capacity[task_id] -= 1
+                    if not capacity[task_id]:
+                        i -= 1
+                        open_ids.pop(i)
+                if i >= len(open_ids):
+                    i = 0
+            return plan
+
+        for slv in slaves:
+            if not open_ids:
+                break
+            best = None
+            for task_id in open_ids:
+                current[task_id] += weight[task_id]
+                if best is None or current[task_id] > current[best]:
+                    best = task_id
+            current[best] -= total
+            plan[best].append(slv)
+            if capacity[best] is not None:
+                capacity[best] -= 1
+                if not capacity[best]:
+                    open_ids.remove(best)
+                    total -= weight[best]
+        return plan
 
     def done(self):
         for work_queue in self.work_queue.values():
@@ -45,6 +190,16 @@ class MultiWorkQueue:
 
     def do_work(self):
 
+        if self.slo_controller is not None:
+            self.slo_controller.update(self)
+
+        if self.rebalance_policy is not None:
+            self.__rebalance()
+            for work_queue in self.work_queue.values():
+                if not work_queue.done():
+                    work_queue.do_work()
+            return
+
         for id, work_queue in self.work_queue.items():
 
             num_slaves = self.num_slaves[id]
@@ -57,6 +212,12 @@ class MultiWorkQueue:
                 #
                 if num_slaves is not None and master.num_slaves() < num_slaves:
                     self.__borrow_a_slave(id, master)
+                #
+                # the num_slaves quota can shrink (see SLOController): give
+                # the slaves above it to masters that need them
+                #
+                elif num_slaves is not None and master.num_slaves() > num_slaves:
+                    self.__lend_a_slave(id, master)
     
                 work_queue.do_work()
             
@@ -77,9 +238,10 @@ class MultiWorkQueue:
             if other_id == id:
                 continue   
             other_num_slaves = self.num_slaves[other_id]
-            if other_work_queue.done() or other_num_slaves is None:
-                other_work_queue.master.move_slave(to_master=master)
-                break
+            if other_work_queue.done() or other_num_slaves is None or \
+               other_work_queue.master.num_slaves() > other_num_slaves:
+                if self.__move_slave(other_id, id):
+                    break
     
     def __lend_a_slave(self, id, master):
         """
@@ -98,8 +260,161 @@ class MultiWorkQueue:
             other_num_slaves = self.num_slaves[other_id]
             if other_num_slaves is None or \
                other_work_queue.master.num_slaves() < other_num_slaves:
-                master.move_slave(to_master=other_work_queue.master)
+                self.__move_slave(id, other_id)
                 break
     
+    def __rebalance(self):
+        """
+        Move idle slaves from the masters above their target number of
+        slaves to the ones below it, several slaves per decision
+        """
+        targets = self.rebalance_policy.targets(self)
+        if not targets:
+            return
+        surplus = {}
+        deficit = {}
+        for id, work_queue in self.work_queue.items():
+            diff = work_queue.master.num_slaves() - targets[id]
+            if diff > 0:
+                surplus[id] = diff
+            elif diff < 0:
+                deficit[id] = -diff
+        for to_id, wanted in deficit.items():
+            for from_id in list(surplus):
+                while wanted and surplus[from_id]:
+                    if not self.__move_slave(from_id, to_id):
+                        # no idle slave left on this master
+                        surplus[from_id] = 0
+                        break
+                    surplus[from_id] -= 1
+                    wanted -= 1
+                if not surplus[from_id]:
+                    del surplus[from_id]
+                if not wanted:
+                    break
+
+    def __move_slave(self, from_id, to_id):
+        """
+        Move an idle slave between two masters and count the migration.
+        Return False when there was no idle slave to move
+        """
+        from_master = self.work_queue[from_id].master
+        to_master   = self.work_queue[to_id].master
+        before = from_master.num_slaves()
+        if self.hosts is None:
+            from_master.move_slave(to_master=to_master)
+        else:
+            #
+            # prefer an idle slave on the home host of the receiving master
+            #
+            ready = from_master.get_ready_slaves()
+            if not ready:
+                return False
+            home  = self.master_hosts[to_id]
+            slave = next((slv for slv in ready if self.hosts[slv] == home), next(iter(ready)))
+            from_master.move_slave(to_master=to_master, slave=slave)
+            if from_master.num_slaves() != before:
+                self.__count_placements(to_id, [slave])
+        if from_master.num_slaves() == before:
+            return False
+        self.migrations       += 1
+        self.lent[from_id]    += 1
+        self.borrowed[to_id]  += 1
+        return True
+    
     def get_completed_work(self, task_id):
         return self.work_queue[task_id].get_completed_work()
+
+    def metrics_snapshot(self):
+        """
+        Return the metrics of every work queue plus the slave migrations
+        between masters
+        """
+        snapshot = {'slave_migrations': self.migrations, 'tasks': {}}
+        if self.hosts is not None:
+            snapshot['topology'] = self.topology_stats()
+        if self.slo_controller is not None:
+            snapshot['slo'] = self.slo_controller.stats()
+        for task_id, work_queue in self.work_queue.items():
+            task = work_queue.metrics_snapshot()
+            task['num_slaves'] = work_queue.master.num_slaves()
+            task['borrowed']   = self.borrowed[task_id]
+            task['lent']       = self.lent[task_id]
+            snapshot['tasks'][task_id] = task
+        return snapshot
+
+    def dump_metrics(self, path):
+        dump_json(self.metrics_snapshot(), path)
+
+
+
+def benchmark_bootstrap(sizes=(100, 1000, 10000, 100000), num_masters=5):
+    """
+    Time the MultiWorkQueue startup (slaves assignment) for growing numbers
+    of slaves, against the former pop(0) round robin loop
+    """
+    import time
+
+    class _Master:
+        def __init__(self):
+            self.slaves = {}
+        def num_slaves(self):
+            return len(self.slaves)
+        def add_slave(self, slave, node, ready=True):
+            self.slaves[slave] = node
+
+    def former_assignment(slaves, masters, limit):
+        slaves = list(slaves)
+        while slaves:
+            for master in masters:
+                if not slaves:
+                    break
+                if limit is None or master.num_slaves() < limit:
+                    slv = slaves.pop(0)
+                    master.add_slave(slv, Node(slv), ready=True)
+
+    for n in sizes:
+        slaves  = range(1, n + 1)
+        details = [(i, _Master(), None) for i in range(num_masters)]
+        start   = time.perf_counter()
+        MultiWorkQueue(slaves, details, {})
+        bulk    = time.perf_counter() - start
+
+        start   = time.perf_counter()
+        former_assignment(slaves, [_Master() for _ in range(num_masters)], None)
+        former  = time.perf_counter() - start
+        print("%6d slaves: bulk %.4fs, former round robin %.4fs" % (n, bulk, former))
+
+
+def benchmark_placement(num_hosts=5, tasks_per_node=20, block_bytes=1 << 20):
+    """
+    Slurm layout of myrun.sh (num_hosts x tasks_per_node ranks, rank 0 is
+    the master process): one task_id homed on every host, compare the
+    fraction of intra-node master/slave assignments and the bytes crossing
+    the interconnect per block dispatched to every slave, with and without
+    the hosts of the slaves
+    """
+    class _Master:
+        def __init__(self):
+            self.slaves = {}
+        def num_slaves(self):
+            return len(self.slaves)
+        def add_slave(self, slave, node, ready=True):
+            self.slaves[slave] = node
+
+    hosts  = ['node%d' % (rank // tasks_per_node) for rank in range(num_hosts * tasks_per_node)]
+    slaves = range(1, len(hosts))
+    homes  = {task_id: 'node%d' % task_id for task_id in range(num_hosts)}
+    for name, topology in (('round robin', None), ('topology aware', hosts)):
+        details = [(task_id, _Master(), None) for task_id in homes]
+        MultiWorkQueue(slaves, details, {}, hosts=topology, master_hosts=homes)
+        intra = sum(1 for task_id, master, _ in details
+                      for slv in master.slaves if hosts[slv] == homes[task_id])
+        remote_bytes = (len(slaves) - intra) * block_bytes
+        print("%-15s intra-node %5.1f%%, %6.1f MB over the interconnect per round of blocks" %
+              (name, 100.0 * intra / len(slaves), remote_bytes / 1e6))
+
+
+if __name__ == '__main__':
+    benchmark_bootstrap()
+    benchmark_placement()
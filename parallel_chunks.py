@@ -0,0 +1,132 @@
+#Parallel encryption and hashing of the chunks of a data block over a thread pool
+__all__=['ParallelChunkCipher']
+
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chunk_cipher import ChunkCipher, EncryptedBlock, NONCE_LEN, TAG_LEN, seal_chunk
+
+
+class ParallelChunkCipher:
+    """
+    ChunkCipher spread over a pool of worker threads: pycryptodome and
+    hashlib release the GIL on large buffers, so the chunks of a block are
+    encrypted (and their ciphertext hashed) on all cores. Every worker
+    writes its chunks into their own slices of the output buffer and of the
+    tag and digest lists, so the result is ordered and byte-identical to
+    the sequential ChunkCipher with the same nonce
+    """
+
+    def __init__(self, key, mode='gcm', chunk_size=1 << 20, workers=None, hash_name='sha256'):
+        ChunkCipher(key, mode, chunk_size)   # checks mode and chunk_size
+        self.key        = key
+        self.mode       = mode
+        self.chunk_size = chunk_size
+        self.workers    = workers or os.cpu_count() or 1
+        self.hash_name  = hash_name
+        self.executor   = ThreadPoolExecutor(max_workers=self.workers,
+                                             thread_name_prefix='chunk-cipher')
+        # statistics
+        self.bytes      = 0
+        self.seconds    = 0.0
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __work(self, key, src, dst, nonce, first, last, tags, digests):
+        cs = self.chunk_size
+        for i in range(first, last):
+            off = i * cs
+            tag = seal_chunk(key, self.mode, nonce, i, cs, src[off:off + cs], dst[off:off + cs])
+            if tag is not None:
+                tags[i * TAG_LEN:(i + 1) * TAG_LEN] = tag
+            if digests is not None:
+                digests[i] = hashlib.new(self.hash_name, dst[off:off + cs]).digest()
+
+    def encrypt(self, data, out=None, nonce=None, digest=True, key=None):
+        """
+        Encrypt data into out (allocated when None) with key (default the
+        key of the cipher, e.g. the key of the block), return the
+        EncryptedBlock over the n bytes written and the list of digests of
+        the encrypted chunks (None when digest is False)
+        """
+        start = time.perf_counter()
+        src = memoryview(data).cast('B')
+        n   = len(src)
+        allocated = out is None
+        if allocated:
+            out = bytearray(n)
+        dst = memoryview(out).cast('B')
+        if len(dst) < n:
+            raise ValueError("output buffer too small")
+        dst = dst[:n]
+        key = self.key if key is None else key
+        nonce    = os.urandom(NONCE_LEN) if nonce is None else nonce
+        chunks   = -(-n // self.chunk_size)
+        tags     = bytearray(chunks * TAG_LEN) if self.mode == 'gcm' else None
+        digests  = [None] * chunks if digest else None
+        # a few contiguous runs of chunks per worker: few tasks, balanced load
+        runs     = min(chunks, self.workers * 4) or 1
+        bounds   = [chunks * r // runs for r in range(runs + 1)]
+        futures  = [self.executor.submit(self.__work, key, src, dst, nonce, bounds[r], bounds[r + 1],
+                                         tags, digests)
+                    for r in range(runs) if bounds[r] < bounds[r + 1]]
+        for future in futures:
+            future.result()
+        self.bytes   += n
+        self.seconds += time.perf_counter() - start
+        return EncryptedBlock(self.mode, nonce, self.chunk_size, tags, out if allocated else dst), digests
+
+    def stats(self):
+        return {'workers': self.workers,
+                'bytes': self.bytes,
+                'seconds': self.seconds,
+                'MB/s': self.bytes / self.seconds / 1e6 if self.seconds else None}
+
+
+def sequential_encrypt(key, mode, chunk_size, data, nonce, out=None, hash_name='sha256'):
+    """
+    Reference path: ChunkCipher then hash of every encrypted chunk, one
+    after another
+    """
+    sealed = ChunkCipher(key, mode, chunk_size).encrypt(data, out, nonce)
+    return sealed, [hashlib.new(hash_name, c).digest() for c in sealed.chunks()]
+
+
+def benchmark(size=256 << 20, workers=(1, 2, 4, 8, 16, 32),
+              chunk_sizes=(64 << 10, 1 << 20, 4 << 20), mode='gcm'):
+    """
+    Scaling of the encryption and hashing of a size bytes block with the
+    number of worker threads, for several chunk sizes. Every result is
+    checked against the sequential path
+    """
+    key   = os.urandom(16)
+    nonce = os.urandom(NONCE_LEN)
+    block = os.urandom(size)
+    out   = bytearray(size)
+    reference_out = bytearray(size)
+    print("%d cores, %d MB block, %s" % (os.cpu_count(), size >> 20, mode))
+    for cs in chunk_sizes:
+        start = time.perf_counter()
+        reference, reference_digests = sequential_encrypt(key, mode, cs, block, nonce, reference_out)
+        base = size / (time.perf_counter() - start) / 1e6
+        print("chunk %7d  sequential  %8.1f MB/s" % (cs, base))
+        for w in workers:
+            with ParallelChunkCipher(key, mode, cs, workers=w) as engine:
+                sealed, digests = engine.encrypt(block, out, nonce)
+                rate = engine.stats()['MB/s']
+            assert sealed.data == reference.data and sealed.tags == reference.tags \
+                and digests == reference_digests
+            print("chunk %7d  %2d workers  %8.1f MB/s  speedup %.2f" % (cs, w, rate, rate / base))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,201 @@
+#Deterministic placement of data chunks and key fragments on nodes (rendezvous / jump consistent hashing)
+__all__=['Placement', 'item_hash', 'jump_hash']
+
+import hashlib
+
+import numpy as np
+
+MASK64 = (1 << 64) - 1
+
+
+def item_hash(item):
+    """
+    Stable 64 bits hash of an identifier (int, str, bytes or a tuple of
+    them), the same on every rank and every run
+    """
+    return int.from_bytes(hashlib.blake2b(repr(item).encode(), digest_size=8).digest(), 'little')
+
+
+def _mix(x):
+    """
+    splitmix64 finalizer on a uint64 array
+    """
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+def _mix64(x):
+    """
+    splitmix64 finalizer on a Python int
+    """
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+
+def jump_hash(key, num_buckets):
+    """
+    Jump consistent hash (Lamping and Veach): bucket of key in
+    [0, num_buckets) in O(log num_buckets)
+    """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & MASK64
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class Placement:
+    """
+    Compute the r nodes holding a chunk or key fragment from its identifier
+    alone, so any rank finds the holders without asking for metadata.
+
+    method 'rendezvous' (highest random weight): the holders are the r
+    nodes with the highest hash(item, node); a lookup scores all the nodes
+    at once with numpy (O(n) vectorized) and a membership change only
+    moves the items of the node that joined or left.
+
+    method 'jump': jump consistent hashing over node slots, O(r log n) per
+    lookup. A removed node leaves a dead slot (skipped by lookups, reused
+    by the next node added), so removing any node, not only the last one,
+    moves only the items it held.
+    """
+
+    def __init__(self, node_ids, method='rendezvous'):
+        if method not in ('rendezvous', 'jump'):
+            raise ValueError("method must be 'rendezvous' or 'jump'")
+        self.method    = method
+        self.node_ids  = list(node_ids)   # slot -> node id, None for a dead slot
+        self.node_hash = np.array([item_hash(('node', n)) for n in self.node_ids], dtype=np.uint64)
+        self.dead      = np.zeros(len(self.node_ids), dtype=bool)
+        self.slot      = {node: s for s, node in enumerate(self.node_ids)}
+        if len(self.slot) != len(self.node_ids):
+            raise ValueError("duplicate node id")
+
+    def __len__(self):
+        return len(self.slot)
+
+    def nodes(self):
+        return [node for node in self.node_ids if node is not None]
+
+    def add_node(self, node_id):
+        if node_id in self.slot:
+            return
+        h = item_hash(('node', node_id))
+        try:
+            s = self.node_ids.index(None)
+            self.node_ids[s]  = node_id
+            self.node_hash[s] = h
+            self.dead[s]      = False
+        except ValueError:
+            s = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self.node_hash = np.append(self.node_hash, np.uint64(h))
+            self.dead      = np.append(self.dead, False)
+        self.slot[node_id] = s
+
+    def remove_node(self, node_id):
+        s = self.slot.pop(node_id)
+        if self.method == 'jump' or s < len(self.node_ids) - 1:
+            self.node_ids[s] = None   # dead slot
+            self.dead[s]     = True
+        else:
+            del self.node_ids[s]
+            self.node_hash = self.node_hash[:s]
+            self.dead      = self.dead[:s]
+
+    def available(self, exclude=()):
+        return len(self.slot) - sum(1 for node in exclude if node in self.slot)
+
+    def __check(self, r, exclude):
+        available = self.available(exclude)
+        if r > available:
+            raise ValueError("%d holders asked, %d nodes available" % (r, available))
+
+    def holders(self, item, r, exclude=()):
+        """
+        The r distinct node ids holding item, never one of exclude
+        """
+        self.__check(r, exclude)
+        h = item_hash(item)
+        if self.method == 'jump':
+            return self.__jump_holders(h, r, exclude)
+        scores = _mix(self.node_hash ^ np.uint64(h))
+        scores[self.dead] = 0
+        for node in exclude:
+            if node in self.slot:
+                scores[self.slot[node]] = 0
+        top = np.argpartition(scores, len(scores) - r)[len(scores) - r:]
+        return [self.node_ids[s] for s in top[np.argsort(scores[top])[::-1]]]
+
+    def __jump_holders(self, h, r, exclude):
+        chosen  = []
+        n       = len(self.node_ids)
+        attempt = 0
+        while len(chosen) < r:
+            # every attempt is an independent key, a rejected slot costs one more O(log n) jump
+            key  = _mix64((h + attempt * 0x9e3779b97f4a7c15) & MASK64)
+            node = self.node_ids[jump_hash(key, n)]
+            attempt += 1
+            if node is not None and node not in exclude and node not in chosen:
+                chosen.append(node)
+        return chosen
+
+    def data_holders(self, item, r, key_nodes, spare=None):
+        """
+        The r holders of a data item, none of them holding a key fragment
+        when possible: over these nodes, else over spare (e.g. the elected
+        nodes around the leaders), and only when neither has r nodes left
+        outside key_nodes, over these nodes without the exclusion
+        """
+        if self.available(key_nodes) >= r:
+            return self.holders(item, r, exclude=key_nodes)
+        if spare is not None and spare.available(key_nodes) >= r:
+            return spare.holders(item, r, exclude=key_nodes)
+        return self.holders(item, r)
+
+    def place_block(self, block_id, fragments, chunks, r, spare=None):
+        """
+        Holders of the key fragments and of the data chunks of a block. No
+        node holds both a key fragment and a data chunk of the same block,
+        unless there are too few nodes for it (see data_holders)
+        """
+        key_holders = [self.holders(('fragment', block_id, i), r) for i in range(fragments)]
+        key_nodes   = set(node for nodes in key_holders for node in nodes)
+        data_holders = [self.data_holders(('chunk', block_id, j), r, key_nodes, spare) for j in range(chunks)]
+        return key_holders, data_holders
+
+    def subset(self, node_ids):
+        """
+        Placement over some of the nodes (e.g. the leaders), same method
+        """
+        return Placement(node_ids, self.method)
+
+
+def measure_movement(n=100, items=20000, r=3):
+    """
+    Fraction of the holder copies that move when a node joins and when a
+    node in the middle leaves, against the ideal 1/(n+1) (the share of the
+    node that joined or left), and the lookup time, for both methods
+    """
+    import time
+    for method in ('rendezvous', 'jump'):
+        placement = Placement(range(n), method)
+        start  = time.perf_counter()
+        before = [set(placement.holders(('chunk', i), r)) for i in range(items)]
+        lookup = (time.perf_counter() - start) / items
+        placement.add_node(n)
+        joined = [set(placement.holders(('chunk', i), r)) for i in range(items)]
+        placement.remove_node(n // 2)
+        left   = [set(placement.holders(('chunk', i), r)) for i in range(items)]
+        moved_join  = sum(len(a - b) for a, b in zip(joined, before)) / (items * r)
+        moved_leave = sum(len(a - b) for a, b in zip(left, joined)) / (items * r)
+        print("%-10s lookup %6.1f us  join moves %.4f (ideal %.4f)  leave moves %.4f (ideal %.4f)" %
+              (method, lookup * 1e6, moved_join, 1 / (n + 1), moved_leave, 1 / (n + 1)))
+
+
+if __name__ == '__main__':
+    measure_movement()
@@ -0,0 +1,97 @@
+#Lightweight metrics of the blockchain cluster work queues
+__all__=['Histogram', 'QueueMetrics', 'dump_json']
+
+import bisect
+import json
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram. Recording a value is a bisect on a small tuple
+    and an integer increment, so it is cheap enough for the dispatch loop
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count   = 0
+        self.sum     = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum   += value
+
+    def quantile(self, q, counts=None):
+        """
+        Return the upper bound of the bucket holding the q-quantile (None
+        when nothing was recorded, +Inf when it falls in the last bucket).
+        counts are the bucket counts to use instead of the whole history,
+        e.g. the difference between two snapshots of self.counts
+        """
+        counts = self.counts if counts is None else counts
+        total  = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        le = [str(b) for b in self.buckets] + ['+Inf']
+        return {'buckets': dict(zip(le, self.counts)),
+                'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'p95': self.quantile(0.95)}
+
+
+class QueueMetrics:
+    """
+    Counters and latency histograms of a single WorkQueue
+    """
+
+    def __init__(self):
+        self.enqueued           = 0
+        self.dispatched         = 0
+        self.completed          = 0
+        self.slave_samples      = 0  # sum of the slaves seen at each dispatch tick
+        self.idle_slave_samples = 0  # slaves left idle at the end of a dispatch tick
+        self.wait_time          = Histogram()  # enqueue -> dispatch
+        self.service_time       = Histogram()  # dispatch -> completion
+        self.latency            = Histogram()  # enqueue -> completion
+
+    def record_tick(self, num_slaves, idle_slaves):
+        self.slave_samples      += num_slaves
+        self.idle_slave_samples += idle_slaves
+
+    def utilisation(self):
+        if not self.slave_samples:
+            return None
+        return 1.0 - self.idle_slave_samples / self.slave_samples
+
+    def snapshot(self, queue_depth=None):
+        return {'queue_depth': queue_depth,
+                'enqueued': self.enqueued,
+                'dispatched': self.dispatched,
+                'completed': self.completed,
+                'slave_utilisation': self.utilisation(),
+                'wait_time': self.wait_time.snapshot(),
+                'service_time': self.service_time.snapshot(),
+                'latency': self.latency.snapshot()}
+
+
+def dump_json(snapshot, path):
+    """
+    Write a metrics snapshot as JSON, e.g. at shutdown of the master loop
+    """
+    with open(path, 'w') as f:
+        json.dump(snapshot, f, indent=2, default=str)
@@ -0,0 +1,224 @@
+#Load aware slave rebalancing between the masters of a MultiWorkQueue
+__all__=['RebalancePolicy']
+
+import math
+import time
+
+
+class RebalancePolicy:
+    """
+    Compute a target number of slaves for every master of a MultiWorkQueue
+    from its backlog (queued and running blocks) and the observed service
+    rate of its slaves, so that every backlog drains in about the same time.
+
+    To avoid moving slaves back and forth the service rates are smoothed
+    (EWMA with weight alpha), a decision is taken at most every interval
+    seconds and a master is resized only when it is off its target by more
+    than hysteresis*target slaves (at least one slave). The hysteresis also
+    bounds the moves: a resized master is brought to the edge of the band
+    around its target, not onto the target, and it is not resized again for
+    cooldown seconds.
+    """
+
+    def __init__(self, interval=0.5, hysteresis=0.5, alpha=0.3, cooldown=1.0, clock=time.monotonic):
+        self.interval    = interval
+        self.hysteresis  = hysteresis
+        self.alpha       = alpha
+        self.cooldown    = cooldown
+        self.clock       = clock
+        self.last_time   = None
+        self.completed   = {}  # task_id -> completed blocks at the last decision
+        self.rates       = {}  # task_id -> smoothed blocks per slave per second
+        self.resized     = {}  # task_id -> time of its last resize
+        self.decisions   = 0
+
+    def targets(self, multi_work_queue):
+        """
+        Return {task_id: target number of slaves}, or None when no master
+        has to be resized now
+        """
+        now = self.clock()
+        if self.last_time is not None and now - self.last_time < self.interval:
+            return None
+        elapsed, self.last_time = (None if self.last_time is None else now - self.last_time), now
+
+        slaves  = {}
+        backlog = {}
+        for task_id, work_queue in multi_work_queue.work_queue.items():
+            slaves[task_id]  = work_queue.master.num_slaves()
+            backlog[task_id] = work_queue.queued + len(work_queue.dispatch_times)
+            completed = work_queue.metrics.completed
+            if elapsed and slaves[task_id]:
+                rate = (completed - self.completed.get(task_id, 0)) / (slaves[task_id] * elapsed)
+                if rate > 0:
+                    old = self.rates.get(task_id)
+                    self.rates[task_id] = rate if old is None else \
+                        self.alpha * rate + (1 - self.alpha) * old
+            self.completed[task_id] = completed
+
+        known = [r for r in self.rates.values() if r > 0]
+        default_rate = sum(known) / len(known) if known else 1.0
+
+        # slave-seconds of work waiting on every master
+        load = {task_id: backlog[task_id] / self.rates.get(task_id, default_rate)
+                for task_id in slaves}
+        targets = self.__allocate(sum(slaves.values()), load, multi_work_queue.num_slaves)
+
+        # masters close to their target, or resized less than cooldown
+        # seconds ago, keep their slaves; the others move to the band edge
+        resize = {}
+        for task_id, target in targets.items():
+            band = max(1, int(self.hysteresis * target))
+            off  = target - slaves[task_id]
+            if abs(off) <= band or now - self.resized.get(task_id, -math.inf) < self.cooldown:
+                continue
+            resize[task_id] = target - band if off > 0 else target + band
+        if not resize:
+            return None
+        for task_id in resize:
+            self.resized[task_id] = now
+        self.decisions += 1
+        return {task_id: resize.get(task_id, slaves[task_id]) for task_id in slaves}
+
+    def __allocate(self, total, load, limits):
+        """
+        Split total slaves proportionally to load, without exceeding the
+        num_slaves limit of each master (None is unlimited). The slaves left
+        over by capped masters are split among the others, the rounding is
+        done with the largest remainders
+        """
+        targets = dict.fromkeys(load, 0)
+        open_ids = [task_id for task_id in load if load[task_id] > 0]
+        left = total
+        while left > 0 and open_ids:
+            weight = sum(load[task_id] for task_id in open_ids)
+            shares = {task_id: left * load[task_id] / weight for task_id in open_ids}
+            capped = [task_id for task_id in open_ids
+                      if limits[task_id] is not None and shares[task_id] >= limits[task_id]]
+            if not capped:
+                floors = {task_id: int(math.floor(share)) for task_id, share in shares.items()}
+                rest = left - sum(floors.values())
+                for task_id in sorted(open_ids, key=lambda t: shares[t] - floors[t], reverse=True)[:rest]:
+                    floors[task_id] += 1
+                for task_id, n in floors.items():
+                    targets[task_id] += n
+                left = 0
+                break
+            for task_id in capped:
+                targets[task_id] = limits[task_id]
+                left -= limits[task_id]
+                open_ids.remove(task_id)
+        # idle slaves nobody can use stay where they are
+        return targets
+
+
+class _SimMaster:
+    """
+    Master simulated on a virtual clock: a slave completes a block after
+    the service time of its task
+    """
+
+    def __init__(self, sim, service_time):
+        self.sim          = sim
+        self.service_time = service_time
+        self.ready        = set()
+        self.running      = {}
+        self.completed    = {}
+        self.nodes        = {}
+
+    def num_slaves(self):
+        return len(self.ready) + len(self.running) + len(self.completed)
+
+    def add_slave(self, slave, node=None, ready=True):
+        self.ready.add(slave)
+        self.nodes[slave] = node
+
+    def move_slave(self, to_master, slave=None):
+        if slave is None:
+            if not self.ready:
+                return
+            slave = next(iter(self.ready))
+        self.ready.discard(slave)
+        to_master.add_slave(slave, self.nodes.pop(slave, None), ready=True)
+
+    def get_ready_slaves(self):
+        return set(self.ready)
+
+    def run(self, slave, data):
+        self.ready.remove(slave)
+        self.running[slave] = (self.sim.now + self.service_time, data)
+
+    def get_completed_slaves(self):
+        for slave, (end, data) in list(self.running.items()):
+            if end <= self.sim.now:
+                del self.running[slave]
+                self.completed[slave] = data
+        return list(self.completed)
+
+    def get_data(self, slave):
+        self.ready.add(slave)
+        return self.completed.pop(slave)
+
+    def done(self):
+        return not self.running and not self.completed
+
+
+def simulate(num_slaves=64, ticks=20000, policy=None, seed=0):
+    """
+    Run three task_ids with skewed service times and bursty arrivals (most
+    of the blocks of a task arrive in a few bursts) and return the mean and
+    p95 enqueue->dispatch wait in virtual seconds, plus the slave migrations
+    """
+    import random
+    from multi_work_queue import MultiWorkQueue
+    from records import Block
+
+    class Sim:
+        now = 0.0
+
+    sim  = Sim()
+    rng  = random.Random(seed)
+    dt   = 0.01
+    spec = {'a': 0.05, 'b': 0.2, 'c': 0.5}   # service time per block
+    masters = {task_id: _SimMaster(sim, s) for task_id, s in spec.items()}
+    queue = MultiWorkQueue(range(1, num_slaves + 1),
+                           [(task_id, masters[task_id], None) for task_id in spec],
+                           {}, rebalance_policy=policy)
+    if policy is not None:
+        policy.clock = lambda: sim.now
+    enqueued = {}
+    waits = []
+    bid = 0
+    for tick in range(ticks):
+        sim.now = tick * dt
+        for task_id in spec:
+            # a burst of 100-200 blocks with probability 0.2%, else a trickle
+            n = rng.randint(100, 200) if rng.random() < 0.002 else int(rng.random() < 0.2)
+            for _ in range(n):
+                block = Block(bid)
+                enqueued[bid] = sim.now
+                queue.add_work(task_id, block, None)
+                bid += 1
+        for task_id, master in masters.items():
+            for slave, (end, data) in list(master.running.items()):
+                if data.bid in enqueued:
+                    waits.append(end - master.service_time - enqueued.pop(data.bid))
+        queue.do_work()
+        for task_id in spec:
+            for _ in queue.get_completed_work(task_id):
+                pass
+    waits.sort()
+    return {'mean_wait': sum(waits) / len(waits),
+            'p95_wait': waits[int(0.95 * len(waits))],
+            'dispatched': len(waits),
+            'migrations': queue.migrations}
+
+
+if __name__ == '__main__':
+    import contextlib, io
+    for name, policy in (('borrow/lend', None), ('rebalance', RebalancePolicy()),
+                         ('rebalance, no cooldown', RebalancePolicy(cooldown=0))):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = simulate(ticks=20000, policy=policy)
+        print("%-22s mean wait %5.2f s  p95 %5.2f s  migrations %5d" %
+              (name, result['mean_wait'], result['p95_wait'], result['migrations']))
@@ -0,0 +1,110 @@
+#Compact block and node records for the blockchain cluster work queues
+__all__=['Block', 'Node']
+
+from array import array
+
+
+class Block:
+    """
+    Block of transactions passed through a WorkQueue. The validators of the
+    block (nodes and response_handler) are small int arrays of slave ranks,
+    allocated when first used, so a block waiting in a queue costs only its
+    slots
+    """
+    __slots__ = ('bid', 'type', 'data', '_nodes', '_response_handler', 'exceptions')
+
+    def __init__(self, bid, type="request", data=None):
+        self.bid               = bid
+        self.type              = type   # "request" or "response"
+        self.data              = data
+        self._nodes            = None
+        self._response_handler = None
+        self.exceptions        = 0
+
+    @property
+    def nodes(self):
+        if self._nodes is None:
+            self._nodes = array('i')
+        return self._nodes
+
+    @property
+    def response_handler(self):
+        if self._response_handler is None:
+            self._response_handler = array('i')
+        return self._response_handler
+
+    def __getstate__(self):
+        return (self.bid, self.type, self.data, self._nodes, self._response_handler, self.exceptions)
+
+    def __setstate__(self, state):
+        (self.bid, self.type, self.data, self._nodes,
+         self._response_handler, self.exceptions) = state
+
+
+class Node:
+    """
+    Blockchain node (slave rank) known by a Master. The list of its
+    transactions is allocated when first used
+    """
+    __slots__ = ('id', 'type', '_txn')
+
+    def __init__(self, id, type="not-leader"):
+        self.id   = id
+        self.type = type
+        self._txn = None
+
+    @property
+    def txn(self):
+        if self._txn is None:
+            self._txn = []
+        return self._txn
+
+    def __getstate__(self):
+        return (self.id, self.type, self._txn)
+
+    def __setstate__(self, state):
+        self.id, self.type, self._txn = state
+
+
+def measure_memory(n=1000000):
+    """
+    Compare the memory per queued block and per node of the dict backed
+    objects with the slotted records, for n objects (the list holding the
+    objects is included)
+    """
+    import tracemalloc
+
+    class DictBlock:
+        def __init__(self, bid, type="request", data=None):
+            self.bid = bid
+            self.type = type
+            self.data = data
+            self.nodes = []
+            self.response_handler = []
+            self.exceptions = 0
+
+    class DictNode:
+        def __init__(self, id, type="not-leader"):
+            self.id = id
+            self.type = type
+            self.txn = []
+
+    for name, factory in (('dict block', DictBlock), ('slotted block', Block),
+                          ('dict node', DictNode), ('slotted node', Node)):
+        tracemalloc.start()
+        objects = [factory(i) for i in range(n)]
+        size, _ = tracemalloc.get_traced_memory()
+        if 'block' in name:
+            # once dispatched, a response block has fault_factor+1 = 3 validators
+            for obj in objects:
+                obj.response_handler.extend((1, 2, 3))
+            dispatched, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del objects
+        print("%-14s %6.1f bytes per object (%d objects)" % (name, size / n, n))
+        if 'block' in name:
+            print("%-14s %6.1f bytes per object after dispatch" % ('', dispatched / n))
+
+
+if __name__ == '__main__':
+    measure_memory()
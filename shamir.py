@@ -0,0 +1,140 @@
+#t-of-n Shamir secret sharing of AES keys over GF(256), vectorized over many keys with NumPy
+__all__=['Shamir']
+
+import os
+import time
+
+import numpy as np
+
+from gf256 import INV, MUL, gf_matmul, gf_pow
+
+
+class Shamir:
+    """
+    Every byte of a key is the constant term of a random polynomial of
+    degree t-1 over GF(256); share x (1..n) is the polynomial evaluated at
+    x. Any t shares give the key back by Lagrange interpolation at 0, t-1
+    shares say nothing about it. One share per node replaces r copies of
+    every contiguous key fragment.
+
+    Splitting is one matrix product: the (n, t) Vandermonde matrix of the
+    share points times the (t, keys*key_len) matrix [keys; coefficients],
+    so thousands of keys are shared (or recombined) in one call
+    """
+
+    def __init__(self, t, n):
+        if not 0 < t <= n <= 255:
+            raise ValueError("need 0 < t <= n <= 255")
+        self.t = t
+        self.n = n
+        self.points  = np.arange(1, n + 1, dtype=np.uint8)
+        self.matrix  = np.array([[gf_pow(x, j) for j in range(t)] for x in range(1, n + 1)], dtype=np.uint8)
+        self.weights = {}   # tuple of t share points -> Lagrange weights at 0
+        # statistics
+        self.keys_split    = 0
+        self.keys_combined = 0
+        self.seconds       = 0.0
+
+    def split(self, keys):
+        """
+        Shares of a (m, key_len) uint8 array (or list of m keys of the same
+        length): a (n, m, key_len) array, shares[i] is the share of point
+        i+1 of every key
+        """
+        start = time.perf_counter()
+        keys = np.asarray([np.frombuffer(k, dtype=np.uint8) for k in keys]
+                          if isinstance(keys, (list, tuple)) else keys, dtype=np.uint8)
+        m, key_len = keys.shape
+        rows = np.empty((self.t, m * key_len), dtype=np.uint8)
+        rows[0] = keys.reshape(-1)
+        rows[1:] = np.frombuffer(os.urandom((self.t - 1) * m * key_len), dtype=np.uint8).reshape(self.t - 1, -1)
+        shares = gf_matmul(self.matrix, rows).reshape(self.n, m, key_len)
+        self.keys_split += m
+        self.seconds    += time.perf_counter() - start
+        return shares
+
+    def __weights(self, points):
+        weights = self.weights.get(points)
+        if weights is None:
+            # l_i(0) = prod_{j != i} x_j / (x_j - x_i), subtraction is XOR
+            weights = np.ones(len(points), dtype=np.uint8)
+            for i, xi in enumerate(points):
+                for xj in points:
+                    if xj != xi:
+                        weights[i] = MUL[weights[i], MUL[xj, INV[xj ^ xi]]]
+            weights = self.weights[points] = weights.reshape(1, -1)
+        return weights
+
+    def combine(self, shares):
+        """
+        Keys back from {share point: (m, key_len) shares} with at least t
+        entries, a (m, key_len) uint8 array
+        """
+        if len(shares) < self.t:
+            raise ValueError("%d shares, %d needed" % (len(shares), self.t))
+        start  = time.perf_counter()
+        points = tuple(sorted(shares)[:self.t])
+        first  = np.asarray(shares[points[0]], dtype=np.uint8)
+        rows   = np.stack([np.asarray(shares[x], dtype=np.uint8).reshape(-1) for x in points])
+        keys   = gf_matmul(self.__weights(points), rows).reshape(first.shape)
+        self.keys_combined += len(first) if first.ndim > 1 else 1
+        self.seconds       += time.perf_counter() - start
+        return keys
+
+    def split_key(self, key):
+        """
+        The n fragments of one key, each one byte share point followed by
+        the share
+        """
+        shares = self.split([bytes(key)])
+        return [bytes([x]) + shares[i, 0].tobytes() for i, x in enumerate(self.points)]
+
+    def combine_key(self, fragments):
+        """
+        Key back from at least t fragments made by split_key
+        """
+        shares = {fragment[0]: np.frombuffer(fragment, dtype=np.uint8, offset=1) for fragment in fragments}
+        return self.combine(shares).tobytes()
+
+    def stats(self):
+        return {'t': self.t,
+                'n': self.n,
+                'keys_split': self.keys_split,
+                'keys_combined': self.keys_combined,
+                'seconds': self.seconds}
+
+
+def benchmark(keys=10000, key_len=16, schemes=((2, 3), (3, 5), (5, 8)), fragments=4, repeat=3):
+    """
+    Split and recombine keys keys of key_len bytes in one call per scheme,
+    against one call per key, and compare the messages and bytes per key
+    with r-fold replication of contiguous fragments tolerating as many
+    lost nodes (r = n-t+1)
+    """
+    batch = np.frombuffer(os.urandom(keys * key_len), dtype=np.uint8).reshape(keys, key_len)
+    print("%d keys of %d bytes" % (keys, key_len))
+    for t, n in schemes:
+        shamir = Shamir(t, n)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            shares = shamir.split(batch)
+        split = (time.perf_counter() - start) / repeat
+        survivors = {x: shares[x - 1] for x in range(n - t + 1, n + 1)}   # the first n-t shares lost
+        start = time.perf_counter()
+        for _ in range(repeat):
+            back = shamir.combine(survivors)
+        combine = (time.perf_counter() - start) / repeat
+        assert np.array_equal(back, batch)
+        sample = [batch[i].tobytes() for i in range(min(keys, 1000))]
+        start = time.perf_counter()
+        for key in sample:
+            assert shamir.combine_key(shamir.split_key(key)[n - t:]) == key
+        one = (time.perf_counter() - start) / len(sample)
+        r = n - t + 1
+        print("%d-of-%d: batch split %5.2f us/key, combine %5.2f us/key | one key per call %6.1f us | "
+              "%d messages, %dx key bytes vs %d fragments x r=%d: %d messages, %dx key bytes" %
+              (t, n, split / keys * 1e6, combine / keys * 1e6, one * 1e6, n, n, fragments, r, fragments * r, r))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,66 @@
+#Latency SLO driven number of slaves per task_id of a MultiWorkQueue
+__all__=['SLOController']
+
+import math
+import time
+
+
+class SLOController:
+    """
+    Grow or shrink the num_slaves quota of every task_id of a
+    MultiWorkQueue from the measured enqueue->completion latency.
+
+    slos is {task_id: (target, min_slaves, max_slaves)}: target is the
+    latency (seconds) that the quantile q of the blocks completed during the
+    last interval must not exceed. The quantile is the upper bound of its
+    histogram bucket (see queue_metrics.LATENCY_BUCKETS). A task_id missing
+    its target gets 25% more slaves (at least one), a task_id well within it
+    (below shrink_ratio*target, or with nothing to do) gives one slave back.
+    The slaves are then moved by the borrow/lend mechanism of
+    MultiWorkQueue.
+    """
+
+    def __init__(self, slos, q=0.95, interval=1.0, shrink_ratio=0.5, clock=time.monotonic):
+        self.slos         = slos
+        self.q            = q
+        self.interval     = interval
+        self.shrink_ratio = shrink_ratio
+        self.clock        = clock
+        self.last_time    = None
+        self.counts       = {}  # task_id -> latency bucket counts at the last update
+        self.observed     = {}  # task_id -> latency quantile of the last interval
+
+    def update(self, multi_work_queue):
+        """
+        Adjust multi_work_queue.num_slaves, at most once every interval seconds
+        """
+        now = self.clock()
+        if self.last_time is not None and now - self.last_time < self.interval:
+            return
+        self.last_time = now
+
+        for task_id, (target, min_slaves, max_slaves) in self.slos.items():
+            work_queue = multi_work_queue.work_queue[task_id]
+            latency    = work_queue.metrics.latency
+            previous   = self.counts.get(task_id, [0] * len(latency.counts))
+            window     = [n - p for n, p in zip(latency.counts, previous)]
+            self.counts[task_id] = list(latency.counts)
+            observed = latency.quantile(self.q, window)
+            self.observed[task_id] = observed
+
+            quota = multi_work_queue.num_slaves[task_id]
+            if quota is None:
+                quota = work_queue.master.num_slaves()
+            if observed is not None and observed > target:
+                quota += max(1, int(math.ceil(quota * 0.25)))
+            elif (observed is None and work_queue.done()) or \
+                 (observed is not None and observed < self.shrink_ratio * target):
+                quota -= 1
+            multi_work_queue.num_slaves[task_id] = max(min_slaves, min(max_slaves, quota))
+
+    def stats(self):
+        return {task_id: {'target': target,
+                          'observed': self.observed.get(task_id),
+                          'min_slaves': min_slaves,
+                          'max_slaves': max_slaves}
+                for task_id, (target, min_slaves, max_slaves) in self.slos.items()}
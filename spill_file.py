@@ -0,0 +1,68 @@
+#Append-only overflow storage of the queued blocks of a work queue
+__all__=['SpillFile', 'SpilledBlock']
+
+import pickle
+import tempfile
+
+
+class SpilledBlock:
+    """
+    Small handle kept in the work queue in place of a block written to the
+    spill file
+    """
+    __slots__ = ('offset', 'length')
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+
+class SpillFile:
+    """
+    Serialize blocks at the end of a file and read them back by offset. The
+    file is truncated when no spilled block is left in it
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            self.file = tempfile.TemporaryFile(prefix='ztp-spill-')
+        else:
+            self.file = open(path, 'w+b')
+        self.outstanding = 0   # spilled blocks not read back yet
+        self.spilled     = 0
+        self.paged_in    = 0
+        self.bytes       = 0
+
+    def append(self, payload):
+        """
+        Write an already pickled block and return its handle
+        """
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        self.file.write(payload)
+        self.outstanding += 1
+        self.spilled     += 1
+        self.bytes       += len(payload)
+        return SpilledBlock(offset, len(payload))
+
+    def load(self, handle):
+        """
+        Read back the block of handle
+        """
+        self.file.seek(handle.offset)
+        data = pickle.loads(self.file.read(handle.length))
+        self.outstanding -= 1
+        self.paged_in    += 1
+        if not self.outstanding:
+            self.file.seek(0)
+            self.file.truncate()
+        return data
+
+    def stats(self):
+        return {'spilled': self.spilled,
+                'paged_in': self.paged_in,
+                'spilled_bytes': self.bytes,
+                'outstanding': self.outstanding}
+
+    def close(self):
+        self.file.close()
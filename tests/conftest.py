@@ -0,0 +1,30 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def key_dist():
+    """
+    key_send/key-dist.py (not an importable module name)
+    """
+    spec = importlib.util.spec_from_file_location('key_dist', os.path.join(ROOT, 'key_send', 'key-dist.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def received(key_dist, monkeypatch):
+    """
+    node id -> data received by the node during the test
+    """
+    got = {}
+    monkeypatch.setattr(key_dist.BlockchainNode, 'receive_data',
+                        lambda node, data: got.setdefault(node.node_id, []).append(data))
+    return got
@@ -0,0 +1,49 @@
+import random
+
+from catalog import MetadataCatalog, KIND_CHUNK, KIND_FRAGMENT
+
+
+def test_insert_again_overwrites_in_place():
+    catalog = MetadataCatalog()
+    for copy in range(100):
+        catalog.insert(1, KIND_CHUNK, [[copy, copy + 1], [copy + 2]])
+    assert len(catalog) == 2
+    assert catalog.block_holders(1, KIND_CHUNK) == [[99, 100], [101]]
+    catalog.insert(1, KIND_CHUNK, [[7]])
+    assert len(catalog) == 2 and catalog.block_holders(1, KIND_CHUNK) == [[7]]
+    assert catalog.items_on_node(101) == []
+
+
+def test_leader_delta_sends_only_what_the_leader_misses():
+    catalog = MetadataCatalog()
+    replica = catalog.replica()
+    catalog.insert(1, KIND_FRAGMENT, [[1, 2]])
+    catalog.insert(1, KIND_CHUNK, [[3, 4], [5, 6]])
+    replica.apply(catalog.leader_delta('leader'))
+    catalog.insert(2, KIND_CHUNK, [[7, 8]])
+    delta = catalog.leader_delta('leader')
+    assert delta['entries'] == [(2, KIND_CHUNK, 1)] and len(delta['holders']) == 1
+    replica.apply(delta)
+    assert catalog.leader_delta('leader')['entries'] == []
+    assert replica.block_holders(2, KIND_CHUNK) == [[7, 8]] and replica.version == catalog.version
+    assert catalog.cursors == {'leader': (catalog.version, len(catalog.node_ids))}
+
+
+def test_replicas_follow_the_primary():
+    rng = random.Random(1)
+    for max_rows in (None, 64):
+        catalog = MetadataCatalog(width=2, max_rows=max_rows)
+        replicas = [catalog.replica() for _ in range(3)]
+        for _ in range(500):
+            holders = [[rng.randrange(40) for _ in range(rng.randrange(1, 4))] for _ in range(rng.randrange(1, 8))]
+            catalog.insert(rng.randrange(30), rng.choice((KIND_CHUNK, KIND_FRAGMENT)), holders)
+            if rng.random() < 0.2:
+                leader = rng.randrange(len(replicas))
+                replicas[leader].apply(catalog.leader_delta(leader))
+        for leader, replica in enumerate(replicas):
+            replica.apply(catalog.leader_delta(leader))
+            assert replica.version == catalog.version
+            for block_kind in catalog.where:
+                # a bounded replica may have evicted a block still in the primary, never kept stale holders
+                if max_rows is None or block_kind in replica:
+                    assert replica.block_holders(*block_kind) == catalog.block_holders(*block_kind)
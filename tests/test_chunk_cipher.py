@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from chunk_cipher import ChunkCipher, EncryptedBlock
+from parallel_chunks import ParallelChunkCipher
+
+KEY = bytes(range(16))
+
+
+@pytest.mark.parametrize('mode', ['ctr', 'gcm'])
+@pytest.mark.parametrize('size', [0, 1, 64, 1000])
+def test_record_round_trip(mode, size):
+    cipher = ChunkCipher(KEY, mode, 64)
+    payload = os.urandom(size)
+    record = cipher.encrypt(payload).to_bytes()
+    assert bytes(cipher.decrypt(EncryptedBlock.from_bytes(record))) == payload
+
+
+@pytest.mark.parametrize('mode', ['ctr', 'gcm'])
+def test_caller_buffer_slack_is_not_part_of_the_block(mode):
+    payload = os.urandom(100)
+    sealed = ChunkCipher(KEY, mode, 64).encrypt(payload, bytearray(4096))
+    assert len(sealed) == 100
+    with ParallelChunkCipher(KEY, mode, 64, workers=2) as engine:
+        parallel, digests = engine.encrypt(payload, bytearray(4096), sealed.nonce)
+    assert len(parallel) == 100 and len(digests) == 2
+    assert bytes(parallel.data) == bytes(sealed.data) and parallel.tags == sealed.tags
+    record = parallel.to_bytes()
+    assert bytes(ChunkCipher(KEY, mode, 64).decrypt(EncryptedBlock.from_bytes(record))) == payload
+
+
+def test_gcm_detects_a_modified_record():
+    cipher = ChunkCipher(KEY, 'gcm', 64)
+    record = bytearray(cipher.encrypt(b'x' * 100).to_bytes())
+    record[-1] ^= 1
+    with pytest.raises(ValueError):
+        cipher.decrypt(EncryptedBlock.from_bytes(record))
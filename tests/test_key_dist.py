@@ -0,0 +1,104 @@
+import itertools
+
+import pytest
+
+from catalog import MetadataCatalog
+from erasure import ReedSolomon
+from key_derivation import KeyDeriver
+from key_pool import KeyPool
+from placement import Placement
+from shamir import Shamir
+
+BLOCK = "This is a large data block that needs to be distributed."
+
+
+def blockchain(key_dist, **options):
+    return key_dist.Blockchain(20, BLOCK, "some shape", 20, 3, "policy1", block_id=7, **options)
+
+
+def test_runs_end_to_end(key_dist, received):
+    chain = blockchain(key_dist)
+    data_chunks, abe_encrypted_keys, key_fragments = chain.ZTP_Data_Key_Dist()
+    assert ''.join(data_chunks) == BLOCK
+    assert len(abe_encrypted_keys) == len(key_fragments) == 1
+    assert all(isinstance(fragment, bytes) for fragment in key_fragments)
+    assert len(chain.chunk_digests) == len(data_chunks)
+
+
+def test_placeholders_take_bytes(key_dist):
+    assert key_dist.abe_encrypt(b'\x00\xff', 'p') == key_dist.abe_encrypt('\x00\xff'.encode('latin-1'), 'p')
+    chain = blockchain(key_dist)
+    assert chain.generate_identifiers([b'ab']) == chain.generate_identifiers(['ab'])
+    assert len(chain.generate_chunk_key('chunk')) == 32
+
+
+def test_key_deriver(key_dist, received):
+    deriver = KeyDeriver(b's' * 32)
+    chain = blockchain(key_dist, key_deriver=deriver)
+    data_chunks, _, key_fragments = chain.ZTP_Data_Key_Dist()
+    assert b''.join(key_fragments) == deriver.block_key(7)
+    sent = [data for node in received.values() for data in node]
+    for index, chunk in enumerate(data_chunks):
+        decrypted = [data for data in sent
+                     if isinstance(data, bytes) and _decrypts(key_dist, data, deriver.chunk_key(7, index)) == chunk]
+        assert len(decrypted) == 3   # redundancy copies
+
+
+def _decrypts(key_dist, data, key):
+    try:
+        return key_dist.aes_decrypt(data, key)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def test_key_deriver_needs_block_id(key_dist):
+    chain = key_dist.Blockchain(20, BLOCK, "s", 20, 3, "p", key_deriver=KeyDeriver(b's' * 32))
+    with pytest.raises(ValueError):
+        chain.ZTP_Data_Key_Dist()
+
+
+def test_key_pool(key_dist, received):
+    pool = KeyPool(low=4, high=16, batch=8)
+    chain = blockchain(key_dist, key_pool=pool)
+    data_chunks, _, _ = chain.ZTP_Data_Key_Dist()
+    assert pool.stats()['takes'] == 2   # the block key, then all the chunk keys in one batch
+    assert pool.stats()['generated'] >= len(data_chunks) + 1
+
+
+def test_erasure_shards_rebuild_chunks(key_dist, received):
+    erasure = ReedSolomon(2, 4)
+    chain = blockchain(key_dist, erasure=erasure)
+    data_chunks, _, _ = chain.ZTP_Data_Key_Dist()
+    for index, chunk in enumerate(data_chunks):
+        length, node_ids = chain.shard_map[index]
+        assert len(set(node_ids)) == erasure.n
+        shards = {i: chain.nodes[node].shards[(7, index, i)] for i, node in enumerate(node_ids)}
+        for kept in itertools.combinations(shards, erasure.k):
+            encrypted = erasure.decode({i: shards[i] for i in kept}, length)
+            assert key_dist.aes_decrypt(encrypted, chain.generate_chunk_key(chunk, index)) == chunk
+
+
+@pytest.mark.parametrize('placement', [None, Placement(range(20))])
+def test_shamir_shares(key_dist, received, placement):
+    shamir = Shamir(2, 3)
+    deriver = KeyDeriver(b's' * 32)
+    chain = blockchain(key_dist, shamir=shamir, key_deriver=deriver, placement=placement)
+    _, abe_encrypted_keys, shares = chain.ZTP_Data_Key_Dist()
+    assert len(abe_encrypted_keys) == len(shares) == 3
+    for kept in itertools.combinations(shares, 2):
+        assert shamir.combine_key(kept) == deriver.block_key(7)
+    with pytest.raises(ValueError):
+        shamir.combine_key(shares[:1])
+
+
+def test_catalog_records_holders(key_dist, received):
+    catalog = MetadataCatalog()
+    chain = blockchain(key_dist, catalog=catalog, placement=Placement(range(20)))
+    data_chunks, _, _ = chain.ZTP_Data_Key_Dist()
+    chunk_holders = catalog.block_holders(7, catalog.KIND_CHUNK)
+    fragment_holders = catalog.block_holders(7, catalog.KIND_FRAGMENT)
+    assert len(chunk_holders) == len(data_chunks)
+    key_nodes = set(node for nodes in fragment_holders for node in nodes)
+    assert all(not key_nodes & set(nodes) for nodes in chunk_holders)
+    for leader in chain.select_leaders(None):
+        assert leader.metadata["catalog"].block_holders(7, catalog.KIND_CHUNK) == chunk_holders
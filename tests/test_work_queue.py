@@ -0,0 +1,89 @@
+from records import Block
+from work_queue import WorkQueue
+
+
+class FakeMaster:
+    """
+    Master of a fixed set of slaves, a slave runs its block until finish()
+    """
+
+    def __init__(self, slaves):
+        self.slaves    = list(slaves)
+        self.ready     = set(slaves)
+        self.running   = {}
+        self.completed = {}
+
+    def get_ready_slaves(self):
+        return set(self.ready)
+
+    def run(self, slave, data):
+        self.ready.discard(slave)
+        self.running[slave] = data
+
+    def finish(self):
+        self.completed.update(self.running)
+        self.running.clear()
+
+    def get_completed_slaves(self):
+        return list(self.completed)
+
+    def get_data(self, slave):
+        self.ready.add(slave)
+        return self.completed.pop(slave)
+
+    def done(self):
+        return not self.running and not self.completed
+
+    def num_slaves(self):
+        return len(self.slaves)
+
+
+def test_every_tick_is_sampled():
+    master = FakeMaster(range(4))
+    queue = WorkQueue(master)
+    queue.do_work()                      # empty queue: 4 idle slaves
+    queue.add_work(Block(1), None)
+    queue.do_work()                      # one block for 4 ready slaves: 3 idle
+    assert queue.metrics.slave_samples == 8
+    assert queue.metrics.idle_slave_samples == 7
+    assert queue.metrics.utilisation() == 1 / 8
+
+
+def test_metrics_follow_the_task_through_the_spill_file():
+    master = FakeMaster(range(2))
+    queue = WorkQueue(master, memory_budget=1, prefetch=0)
+    blocks = [Block(i, data=b'x' * 1000) for i in range(6)]
+    for block in blocks:
+        queue.add_work(block, None)
+    assert queue.spill_file.stats()['spilled'] == 6
+    while not queue.done():
+        queue.do_work()
+        master.finish()
+        completed = list(queue.get_completed_work())
+        assert all(isinstance(block, Block) for block in completed)
+    assert queue.metrics.enqueued == queue.metrics.dispatched == queue.metrics.completed == 6
+    assert queue.metrics.wait_time.count == 6 and not queue.enqueue_times and not queue.block_sizes
+
+
+def test_response_waits_for_fault_factor_plus_one_slaves():
+    master = FakeMaster(range(2))
+    queue = WorkQueue(master, fault_factor=2)
+    block = Block(1, type="response")
+    queue.add_work(block, None)
+    queue.do_work()                      # 2 slaves for 3 replicas: not run, still queued
+    assert not master.running and queue.queued == 1 and not queue.dead_letter
+    master.slaves.append(2)
+    master.ready.add(2)
+    queue.do_work()
+    assert sorted(master.running) == [0, 1, 2] and sorted(block.response_handler) == [0, 1, 2]
+    assert queue.queued == 0 and not queue.deferred
+
+
+def test_fully_replicated_response_is_dead_lettered():
+    master = FakeMaster(range(3))
+    queue = WorkQueue(master, fault_factor=1)
+    block = Block(1, type="response")
+    block.response_handler.extend([0, 1])
+    queue.add_work(block, None)
+    queue.do_work()
+    assert not master.running and queue.dead_letter == [block] and queue.done()
@@ -3,19 +3,60 @@ __all__=['WorkQueue']
  
 import logging
 import copy
+import heapq
+import pickle
+import itertools
+import random
+import time
+from collections import OrderedDict, deque
 from mpi4py import MPI
+from queue_metrics import QueueMetrics
+from spill_file import SpillFile, SpilledBlock
+from records import Node
 
 class WorkQueue:
     """
     Handle a work queue on a particular Master
     """
    
-    def __init__(self, master):
+    def __init__(self, master, cache_capacity=4, fault_factor=2,
+                 max_retries=3, retry_base_delay=0.1, retry_max_delay=10.0,
+                 memory_budget=None, spill_path=None, prefetch=8):
         #self.comm = MPI.COMM_WORLD
         self.master = master
-        self.work_queue           = []
+        self.work_queue           = deque()
         self.resources_work_queue = {}
-        self.slave_resources      = {}
+        self.slave_resources      = {}  # slave -> LRU of resident resource ids
+        self.resource_residents   = {}  # resource id -> number of slaves holding it
+        self.cache_capacity       = cache_capacity
+        self.cache_hits           = {}
+        self.cache_misses         = {}
+        self.fault_factor         = fault_factor  # Assumption of total faulty/byzantine nodes
+        self.retry_queue          = []  # heap of (eligible time, seq, task id, data, resource id)
+        self.retry_seq            = itertools.count()
+        self.dead_letter          = []
+        self.payload_failures     = {}  # task id -> failures of a payload that is not a Block
+        self.max_retries          = max_retries
+        self.retry_base_delay     = retry_base_delay
+        self.retry_max_delay      = retry_max_delay
+        self.retries              = 0
+        self.dead_lettered        = 0
+        self.deferred             = set()  # task ids of responses waiting for fault_factor+1 slaves
+        self.queued               = 0   # blocks waiting in the work queues
+        self.task_ids             = itertools.count()  # task id of every block added, kept across retries
+        self.enqueue_times        = {}  # task id -> time the block was queued
+        self.dispatch_times       = {}  # slave -> (dispatch time, enqueue time) of its current block
+        self.metrics              = QueueMetrics()
+        #
+        # blocks queued beyond memory_budget bytes (pickled size) are
+        # written to a spill file, the first prefetch blocks of every queue
+        # are kept in memory ahead of dispatch
+        #
+        self.memory_budget        = memory_budget
+        self.prefetch             = prefetch
+        self.resident_bytes       = 0
+        self.block_sizes          = {}  # task id -> pickled size of a resident block
+        self.spill_file           = SpillFile(spill_path) if memory_budget is not None else None
         self.node = 0
 
 
@@ -24,7 +65,7 @@ class WorkQueue:
         Return True when there is no more work to do, the slaves are idle and
         get_completed_work has been called for all the completed slaves
         """
-        return self.__work_queues_empty() and self.master.done()
+        return self.__work_queues_empty() and not self.retry_queue and self.master.done()
 
     def add_work(self, data, node, resource_id=None):
         """
@@ -34,99 +75,175 @@ class WorkQueue:
         self.node = node
         self.__add_data(data, resource_id)
         #print("work-queue: ",node.id)
-    '''
-    Note: The do_work perfectly assign all the blocks to MULTIPLE nodes when total nodes >= 10 and fault_factor>=3
-    '''
     def do_work(self):
-        try:    
+        """
+        Assign the queued blocks to the ready slaves. A request block is run
+        by a single slave, a response block is run by exactly fault_factor+1
+        distinct slaves so that up to fault_factor faulty/byzantine validators
+        are tolerated
+        """
+        task = data = None
+        resource_id = None
+        # every tick is sampled, an empty queue included: the ready slaves
+        # are counted before any is popped, the ones given no work are idle
+        num_slaves   = self.master.num_slaves()
+        avail_slaves = []
+        try:
+            self.__requeue_eligible_retries()
+            avail_slaves = list(self.master.get_ready_slaves())
             if self.__work_queues_empty():
                 return
-        
-            avail_slaves = []
-            assigned = False 
-            avail_slaves = self.master.get_ready_slaves()
-            leader = 0
-            fault_factor = 2 # Assumption of total faulty/byzantine nodes 
-            while len(avail_slaves)>0:#=fault_factor-1:#2: # and not (self.__work_queues_empty()):#len(avail_slaves)>0:
-                slave = avail_slaves.pop() 
+
+            while avail_slaves:
+                slave = avail_slaves.pop()
+                # nothing popped yet: a failure before the pop must not retry the previous block
+                task = data = None
+                resource_id = None
             #############################################
             #If the cluster has few nodes, then work continues if at-least a leader exists 
             #############################################
-                data, resource_id = self.__get_data_for_slave(slave)
-            
+                (task, data), resource_id = self.__get_data_for_slave(slave)
+
                 if data is None:
-                    break    
-            
-                else:  #if slave in self.master.nodestatus:
-                    self.slave_resources[slave] = resource_id
-            
-                
-                #self.master.nodestatus[slave] is the status of a master, it is an integer value that holds total earned token of master 
-                    '''
-                    if slave in self.master.nodestatus and self.master.nodestatus[slave]>= 2 and len(avail_slaves)<=1:
-                        data.nodes.append(slave)
-                        self.master.run(slave, data)
-                        print("Block",data.bid,"assigned to leader",slave, "Token ", self.master.nodestatus[slave])
-                    '''
-
-                    ''' 
-                    if data.type == "response":
-                        print("Only response check of block ",data.bid, "data nodes",data.nodes)
-                    '''
-                    #if data.type == "response" and slave not in data.nodes and slave in self.master.ready:
-                    if data.type == "response" and  slave in self.master.ready: #slave in self.master.nodestatus:
-                        #if len(avail_slaves)>0:
-                        while len(data.response_handler) <= fault_factor and slave not in data.response_handler: # and len(avail_slaves)>0:# and slave in self.master.nodestatus:#and len(self.master.nodestatus)<=fault_factor : # and self.master.nodes[slave].type == "not-leader":
-                        #self.master.nodes[slave].txn.append(data) 
-                            data.response_handler.append(slave)
-                            #print("Block",data.bid,"Assigned to a slave", slave, "has handlers ",data.response_handler)# "Token ",self.master.nodestatus[slave])
-                            
-                            self.master.run(slave,data)
-                        
-                            if len(avail_slaves)<=0: # and (len(data.nodes)>=fault_factor):
-                                break
-                            if (len(data.nodes)>=fault_factor):
-                                break
-                            slave = avail_slaves.pop()
-                        #print("Block",data.bid, "has handlers ",data.response_handler)
-                    elif data.type == "request"  and slave in self.master.ready:
-                        data.nodes.append(slave)
-                        self.master.run(slave,data)
-                    '''
-                    if len(data.nodes)<=fault_factor-2 and slave in self.master.nodestatus and self.master.nodestatus[slave]<=fault_factor-1:# and data.exceptions>3:
-                        self.__add_data(data,None)
-                        print("Block",data.bid, "is added back")
-                    
-                    #print("Slave is there ",slave, "token",self.master.nodestatus[slave], "Total validators ",len(data.nodes))
-                    
-                    if slave in self.master.nodestatus and self.master.nodestatus[slave]>= 1  and len(data.nodes)<=1:#len(avail_slaves)<=fault_factor-1:
+                    avail_slaves.append(slave)  # nothing left for it, the slave stays idle
+                    break
+
+                # a plain payload (a tuple, a dict) is run like a request,
+                # as with mpi_master_slave.WorkQueue
+                kind = getattr(data, 'type', 'request')
+                if kind == "response":
+                    #
+                    # the slave chosen by resource affinity is the first
+                    # replica, the others are taken from the remaining ready
+                    # slaves
+                    #
+                    avail_slaves.append(slave)
+                    if not self.__dispatch_response(task, data, resource_id, avail_slaves):
+                        # not enough ready slaves left: keep the block at the
+                        # head of its queue until the next tick
+                        self.__push_back_data(task, data, resource_id)
+                        break
+                elif kind == "request":
+                    self.__touch_resource(slave, resource_id)
+                    self.__run(slave, task, data)
+                    if hasattr(data, 'nodes'):
                         data.nodes.append(slave)
-                        self.master.run(slave, data)
-                        print("Block",data.bid,"assigned to leader",slave, "Token ", self.master.nodestatus[slave])
-                    '''
-                    '''
-                    if len(data.response_handler)<=1 and data.exceptions<=3: # and slave in self.master.ready:
-                        print("Block",data.bid,"need more assignment")
-                        print("Validators avaiable",len(avail_slaves))
-                        #data.response_handler.append(slave)
-                        #self.master.run(slave, data)
-                        self.__add_data(data,None)
-                        data.exceptions += 1
-                    '''
-                    '''
-                    if slave in self.master.ready:
-                        print("salve",slave, "is in ready list")
-                    '''
         except Exception as ex:
-            if len(data.nodes)<=fault_factor-2 and data.exceptions<=3:
-                self.__add_data(data,None)
-                data.exceptions += 1
-                print("Block",data.bid, "is added back after exception")
+            # every failed dispatch is retried or dead-lettered, whatever fault_factor is
+            if data is not None:
+                self.__retry_or_dead_letter(task, data, resource_id)
             
             logging.error(logging.traceback.format_exc())
             print("Resource not available", ex)
             pass        
+        finally:
+            self.metrics.record_tick(num_slaves, len(avail_slaves))
+
+    def retry_stats(self):
+        """
+        Return the number of retried and dead-lettered blocks, and the number
+        of blocks currently waiting for their retry
+        """
+        return {'retries': self.retries,
+                'dead_lettered': self.dead_lettered,
+                'waiting_retry': len(self.retry_queue)}
+
+    def __failures(self, task, data):
+        """
+        Count one more failure of data and return its count. A Block counts
+        its own failures, other payloads are counted by task id until they
+        are dead-lettered
+        """
+        if hasattr(data, 'exceptions'):
+            data.exceptions += 1
+            return data.exceptions
+        failures = self.payload_failures.get(task, 0) + 1
+        self.payload_failures[task] = failures
+        return failures
 
+    def __retry_or_dead_letter(self, task, data, resource_id):
+        """
+        Schedule a failed block for a later retry with exponential backoff and
+        jitter, so a block that keeps failing doesn't take the slaves away from
+        healthy work. After max_retries the block goes to the dead letter list.
+        """
+        failures = self.__failures(task, data)
+        label = getattr(data, 'bid', data)
+        if failures > self.max_retries:
+            self.__dead_letter(task, data)
+            print("Block",label, "is dead-lettered after",self.max_retries,"retries")
+            return
+
+        delay = min(self.retry_max_delay,
+                    self.retry_base_delay * (2 ** (failures - 1)))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        heapq.heappush(self.retry_queue,
+                       (time.monotonic() + delay, next(self.retry_seq), task, data, resource_id))
+        self.retries += 1
+        print("Block",label, "is scheduled for retry in %.3fs" % delay)
+
+    def __dead_letter(self, task, data):
+        self.enqueue_times.pop(task, None)
+        self.payload_failures.pop(task, None)
+        self.deferred.discard(task)
+        self.dead_letter.append(data)
+        self.dead_lettered += 1
+
+    def __requeue_eligible_retries(self):
+        """
+        Move the blocks whose backoff delay expired back to the work queues
+        """
+        now = time.monotonic()
+        while self.retry_queue and self.retry_queue[0][0] <= now:
+            _, _, task, data, resource_id = heapq.heappop(self.retry_queue)
+            self.__add_data(data, resource_id, task)
+
+    def __dispatch_response(self, task, data, resource_id, avail_slaves):
+        """
+        Run a response block on the fault_factor+1 replicas it still needs,
+        popping distinct slaves from avail_slaves. Either all the missing
+        replicas are assigned or none is, so a block is never over/under
+        replicated when the ready slaves run out. Return False when the block
+        must wait: it stays queued while the cluster has fewer than
+        fault_factor+1 slaves. A block that already has all its replicas
+        is dead-lettered, not dispatched again.
+        """
+        replicas = self.fault_factor + 1
+        handlers = set(data.response_handler)
+        needed   = replicas - len(handlers)
+        label    = getattr(data, 'bid', data)
+
+        if needed <= 0:
+            self.__dead_letter(task, data)
+            print("Block",label, "already has",len(handlers),"replicas, it is dead-lettered")
+            return True
+        if self.master.num_slaves() < replicas:
+            if task not in self.deferred:
+                self.deferred.add(task)
+                print("Block",label, "waits for",replicas,"slaves, the cluster has",self.master.num_slaves())
+            return False
+
+        enqueued = self.enqueue_times.get(task)
+        chosen  = []
+        skipped = []
+        while avail_slaves and len(chosen) < needed:
+            slave = avail_slaves.pop()
+            if slave in handlers:
+                skipped.append(slave)
+            else:
+                chosen.append(slave)
+        avail_slaves.extend(skipped)
+
+        if len(chosen) < needed:
+            avail_slaves.extend(chosen)
+            return False
+
+        self.deferred.discard(task)
+        for slave in chosen:
+            self.__touch_resource(slave, resource_id)
+            self.__run(slave, task, data, enqueued)
+            data.response_handler.append(slave)
+        return True
 
     def do_work2(self):
         """
@@ -149,7 +266,7 @@ class WorkQueue:
             if slave in self.master.nodes:   #checking availability of key in queue
                 print(self.master.nodes[slave].id)
             '''
-            data, resource_id = self.__get_data_for_slave(slave)
+            (task, data), resource_id = self.__get_data_for_slave(slave)
             
             if data is not None:
                 #data.nodes.append(slave)
@@ -159,8 +276,7 @@ class WorkQueue:
                     #self.master.nodes[slave].txn.append(data)
                     pass
                 else: # The slave is not available in the master nodes list as ready states
-                    self.node.id = slave
-                    self.master.nodes[slave] = self.node
+                    self.master.nodes[slave] = Node(slave)
                     #print("Null k dorchi ",slave)
                 #self.master.nodes[slave].txn.append(data) # In-memory txn storing. There should two queues: under-process txn & validated-txn
             
@@ -198,9 +314,9 @@ class WorkQueue:
                 break
 
             # bind this slave to resource_id (that can be None)
-            self.slave_resources[slave] = resource_id
+            self.__touch_resource(slave, resource_id)
 
-            self.master.run(slave, data)
+            self.__run(slave, task, data)
             #print(slave.type)
         
     def get_completed_work(self):
@@ -208,8 +324,41 @@ class WorkQueue:
         Fetch the return value of slave that completed its work
         """
         for slave in self.master.get_completed_slaves():
+            dispatched, enqueued = self.dispatch_times.pop(slave, (None, None))
+            now = time.monotonic()
+            if dispatched is not None:
+                self.metrics.service_time.record(now - dispatched)
+            if enqueued is not None:
+                self.metrics.latency.record(now - enqueued)
+            self.metrics.completed += 1
             yield self.master.get_data(slave)
 
+    def metrics_snapshot(self):
+        """
+        Return queue depth, latency histograms, slave utilisation, cache and
+        retry statistics of this work queue
+        """
+        snapshot = self.metrics.snapshot(queue_depth=self.queued)
+        snapshot['retry'] = self.retry_stats()
+        snapshot['cache'] = self.cache_stats()
+        if self.spill_file is not None:
+            snapshot['spill'] = self.spill_file.stats()
+            snapshot['spill']['resident_bytes'] = self.resident_bytes
+        return snapshot
+
+    def cache_stats(self):
+        """
+        Return the resource cache hits, misses and hit ratio of every slave
+        that has been given work bound to a resource
+        """
+        stats = {}
+        for slave in set(self.cache_hits) | set(self.cache_misses):
+            hits   = self.cache_hits.get(slave, 0)
+            misses = self.cache_misses.get(slave, 0)
+            stats[slave] = {'hits': hits, 'misses': misses,
+                            'hit_ratio': hits / (hits + misses)}
+        return stats
+
 
     def __work_queues_empty(self):
         """
@@ -218,39 +367,157 @@ class WorkQueue:
         """
         return not self.work_queue and not self.resources_work_queue
 
-    def __add_data(self, data, resource_id):
+    def __run(self, slave, task, data, enqueued=None):
+        """
+        Send data to slave and record its enqueue->dispatch latency. enqueued
+        is the enqueue time of a block already sent to other replicas
+        """
+        self.master.run(slave, data)
+        now = time.monotonic()
+        first = self.enqueue_times.pop(task, None)
+        if first is not None:
+            self.metrics.wait_time.record(now - first)
+            self.metrics.dispatched += 1
+            enqueued = first
+        self.dispatch_times[slave] = (now, enqueued)
+
+    def __add_data(self, data, resource_id, task=None):
+        """
+        Queue data under task, a retried block keeps the task id it was
+        first given (its metrics and failures stay with it)
+        """
+        if task is None:
+            task = next(self.task_ids)
+            self.enqueue_times[task] = time.monotonic()
+            self.metrics.enqueued += 1
+        self.queued += 1
+        item = (task, self.__spill_data(task, data))
         if resource_id is None:
             # Anonymous work queue
-            self.work_queue.append(data)
+            self.work_queue.append(item)
             #print("Anonymous Block ",data.bid)
         else:
             # add a task in the work queue with specifc resource_id
-            work_queue = self.resources_work_queue.get(resource_id, list()) #Assign the job to a specific node
-            work_queue.append(data)
+            work_queue = self.resources_work_queue.get(resource_id, deque()) #Assign the job to a specific node
+            work_queue.append(item)
             self.resources_work_queue[resource_id] = work_queue
             #print("Assigned to resource", resource_id)
-            print("data added Block",data.bid)
+            print("data added Block",getattr(data, 'bid', data))
+
+    def __push_back_data(self, task, data, resource_id):
+        """
+        Put back data at the head of the work queue it was popped from
+        """
+        self.queued += 1
+        if self.memory_budget is not None:
+            self.__hold_data(task, len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+        if resource_id is None:
+            self.work_queue.appendleft((task, data))
+        else:
+            work_queue = self.resources_work_queue.get(resource_id, deque())
+            work_queue.appendleft((task, data))
+            self.resources_work_queue[resource_id] = work_queue
 
     def __pop_data(self, resource_id):
         """
-        Pop next task from the work queue with specifc resource_id
+        Pop next task from the work queue with specifc resource_id, return
+        its (task id, data), (None, None) when there is none
         """
-        data = None
+        item = None
         if resource_id is None:
             # Anonymous work queue
             if self.work_queue:
-                data = self.work_queue.pop(0)
+                work_queue = self.work_queue
+                item = work_queue.popleft()
         elif resource_id in self.resources_work_queue:
             # work queue with resource id
             work_queue = self.resources_work_queue[resource_id]
-            data = work_queue.pop(0)
+            item = work_queue.popleft()
             if not work_queue:
                 del self.resources_work_queue[resource_id]
+        if item is None:
+            return None, None
+        task, data = item
+        self.queued -= 1
+        if self.spill_file is not None:
+            if isinstance(data, SpilledBlock):
+                data = self.__page_in(task, data)
+            self.resident_bytes -= self.block_sizes.pop(task, 0)
+            self.__prefetch(work_queue)
+        return task, data
+
+    def __hold_data(self, task, size):
+        """
+        Account size bytes of memory for a block kept in the work queue
+        """
+        self.block_sizes[task] = size
+        self.resident_bytes += size
+
+    def __spill_data(self, task, data):
+        """
+        Return data itself when it fits in the memory budget, otherwise write
+        it to the spill file and return its handle. Since blocks are spilled
+        as they are queued, the spilled ones are the farthest from dispatch.
+        A spilled block is read back as a copy of the original object.
+        """
+        if self.spill_file is None:
+            return data
+        payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self.resident_bytes + len(payload) <= self.memory_budget:
+            self.__hold_data(task, len(payload))
+            return data
+        return self.spill_file.append(payload)
+
+    def __page_in(self, task, handle):
+        """
+        Read back a spilled block, its metrics stay under its task id
+        """
+        data = self.spill_file.load(handle)
+        self.__hold_data(task, handle.length)
         return data
 
+    def __prefetch(self, work_queue):
+        """
+        Page in the spilled blocks among the next ones to be dispatched from
+        work_queue, so that dispatch doesn't wait on the spill file
+        """
+        for i in range(min(self.prefetch, len(work_queue))):
+            task, item = work_queue[i]
+            if isinstance(item, SpilledBlock):
+                work_queue[i] = (task, self.__page_in(task, item))
+
+    def __touch_resource(self, slave, resource_id):
+        """
+        Record that slave has acquired resource_id. Each slave keeps an LRU
+        set of at most cache_capacity resources, the least recently used one
+        is evicted when the slave acquires a new resource.
+        """
+        if resource_id is None:
+            return
+
+        cache = self.slave_resources.get(slave)
+        if cache is None:
+            cache = self.slave_resources[slave] = OrderedDict()
+
+        if resource_id in cache:
+            cache.move_to_end(resource_id)
+            self.cache_hits[slave] = self.cache_hits.get(slave, 0) + 1
+            return
+
+        self.cache_misses[slave] = self.cache_misses.get(slave, 0) + 1
+        cache[resource_id] = True
+        self.resource_residents[resource_id] = self.resource_residents.get(resource_id, 0) + 1
+        while len(cache) > self.cache_capacity:
+            evicted, _ = cache.popitem(last=False)
+            residents = self.resource_residents[evicted] - 1
+            if residents:
+                self.resource_residents[evicted] = residents
+            else:
+                del self.resource_residents[evicted]
+
     def __get_data_for_slave(self, slave):
         """
-        Try to assign a resource to the same slave that processed it last time,
+        Try to assign a resource that is already resident in the slave cache,
         This increase caching efficiency as the slave has already acquired the
         resource.
         Also this avoid that different slaves spend time acquiring the same
@@ -260,42 +527,39 @@ class WorkQueue:
         """
 
         if self.__work_queues_empty():
-            return None, None
-
-        resources_to_process = set(self.resources_work_queue.keys())
-        not_assigned_resources = resources_to_process - set(self.slave_resources.values())
+            return (None, None), None
 
-        resource_id = self.slave_resources.get(slave)
-        data = None
+        item = (None, None)
 
         #
-        # Try to assign this slave to its previous resource if the slave has
-        # a resource already assigned.
+        # Try to assign this slave to one of its resident resources, most
+        # recently used first
         #
-        if resource_id is not None:
-            data = self.__pop_data(resource_id)        
+        for resource_id in reversed(self.slave_resources.get(slave, ())):
+            if resource_id in self.resources_work_queue:
+                return self.__pop_data(resource_id), resource_id
 
         #
         # Try to fetch next task from the work queue without resources
         #
-        if data is None:
-            resource_id = None
-            data = self.__pop_data(resource_id)
+        resource_id = None
+        item = self.__pop_data(resource_id)
 
         #
         # Try to assign this slave to a resource nobody else is using
-        #        
-        if data is None:
-            if not_assigned_resources:
-                resource_id = next(iter(not_assigned_resources))
-                data = self.__pop_data(resource_id)
+        #
+        if item[1] is None:
+            for resource_id in self.resources_work_queue:
+                if resource_id not in self.resource_residents:
+                    item = self.__pop_data(resource_id)
+                    break
 
         #
         # Finally, assign this slave to a resource in use by other slaves
-        #        
-        if data is None:
-            if resources_to_process:
-                resource_id = next(iter(resources_to_process))
-                data = self.__pop_data(resource_id)
+        #
+        if item[1] is None:
+            if self.resources_work_queue:
+                resource_id = next(iter(self.resources_work_queue))
+                item = self.__pop_data(resource_id)
         #print(data) 
-        return data, resource_id
+        return item, resource_id